@@ -3,45 +3,185 @@
 这是拼音输入法的入口文件，应助教要求专程放在bin目录下
 但我不得不指出这种文件结构对Python项目是非常不适合的
 也不知道助教会不会看，如果看到的话希望明年能重新要求
-比如说下面我要先调整一下工作路径，否则会出现路径问题
-并且我甚至要考虑助教是在bin目录下运行的还是根目录下
+现在根据本文件的位置找到 src 目录，不再切换工作路径
+所以在 bin 目录下还是根目录下运行都可以，相对路径也照常
+
+用法：
+    python bin/pinyin.py input.txt output.txt       逐块转换文件
+    echo "ni hao" | python bin/pinyin.py            从标准输入逐行读入，逐行输出并立即刷新，可以放进管道
+    python bin/pinyin.py --model pinyin - out.txt   "-" 表示标准输入或标准输出
+只会导入所选模型的模块，模型文件不存在需要训练时才会导入 pypinyin 和 tqdm
 """
 import sys
-import os
-try:
-    from tqdm import tqdm
-except ImportError:
-    # 谨防助教没有 tqdm
-    def tqdm(iteratable):
-        length = iteratable.__len__()
-        for current, each in enumerate(iteratable):
-            print('\rFinished %d / %d' % (current, length), end='', file=sys.stderr, flush=True)
-            yield each
-        print('\rFinished %d / %d' % (length, length), file=sys.stderr, flush=True)
-
-os.chdir('../src')
-sys.path.append('.')
+from argparse import ArgumentParser
+from heapq import nlargest
+from itertools import islice
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parent.parent.joinpath('src')
+sys.path.insert(0, str(SRC))
 import models
 from utils.exception import StrangePinyinError
 
 
-def usage():
-    print("Usage: python pinyin.py <path/to/input_file> <path/to/output_file>")
+_model = None
+_model_name = 'trigram'
+_model_path = None
+
 
+def load_model():
+    global _model
+    if _model is None:
+        model_path = _model_path or str(SRC.joinpath(_model_name + '.sqlite3'))
+        if not Path(model_path).exists():
+            # 只有需要训练时才导入训练模块，以及它用到的 pypinyin 和 tqdm
+            print('INFO: no model file at', model_path, 'and try to build model', file=sys.stderr)
+            models.build_module(_model_name).train(str(SRC.joinpath('data')), model_path)
+        _model = models.model_class(_model_name)(model_path)
+    return _model
 
-def main(input_file, output_file=sys.stdout):
-    model = models.TrigramModel()
-    file_out = open(output_file, 'w')
-    lines = [line.strip() for line in open(input_file) if line.strip()]
-    for line in tqdm(lines):
+
+def decode(lines, slowest=0):
+    """
+    返回 (转换结果, 本块中最慢的 slowest 行的统计信息)
+    """
+    model = load_model()
+    if not slowest:
+        return model.predict_many(lines), []
+    # 需要统计信息时逐行解码，以便得到每一行的耗时
+    stats, results = [], []
+    model.observe(stats.append)
+    for line in lines:
         try:
-            print(model.predict(line), file=file_out)
-        except StrangePinyinError as e:
-            print('遇到了无法处理的拼音', e.args[0])
+            results.append(model.predict(line))
+        except StrangePinyinError:
+            results.append(None)
+    model.observe(None)
+    return results, nlargest(slowest, stats, key=lambda x: x['total_ms'])
+
+
+def read_chunks(input_file, chunk):
+    """
+    惰性读入，每次只取 chunk 行，保证内存占用有界
+    """
+    with open(input_file) as file_in:
+        lines = (line.strip() for line in file_in)
+        while True:
+            lines_chunk = list(islice(lines, chunk))
+            if not lines_chunk:
+                return
+            yield lines_chunk
+
+
+def write_chunk(file_out, lines, results):
+    for line, result in zip(lines, results):
+        if result is None:
+            # 输出空行占位，保证输出与输入逐行对应
+            print('遇到了无法处理的拼音', line, file=sys.stderr)
+            result = ''
+        file_out.write(result + '\n')
+
+
+def stream(file_in, file_out):
+    """
+    逐行转换并立即刷新输出，内存占用与输入长度无关，适合放在管道中
+    """
+    model = load_model()
+    for line in file_in:
+        line = line.strip()
+        try:
+            result = model.predict(line) if line else ''
+        except StrangePinyinError:
+            print('遇到了无法处理的拼音', line, file=sys.stderr)
+            result = ''
+        file_out.write(result + '\n')
+        file_out.flush()
+
+
+def progress(iterable, unit=''):
+    try:
+        from tqdm import tqdm
+    except ImportError:
+        # 谨防助教没有 tqdm
+        def tqdm(iterable, unit=''):
+            current = 0
+            for each in iterable:
+                print('\rFinished %d %s' % (current, unit), end='', file=sys.stderr, flush=True)
+                yield each
+                current += 1
+            print('\rFinished %d %s' % (current, unit), file=sys.stderr, flush=True)
+    return tqdm(iterable, unit=unit)
+
+
+def main(input_file, output_file, processes=1, chunk=1000, slowest=0):
+    from collections import deque
+    from multiprocessing import get_context
+    # 先在主进程中载入模型，fork 出的子进程直接共享，不必各自重新载入
+    # 必须用 fork 启动子进程，spawn 不会继承已载入的模型和 --model 等全局设置
+    load_model()
+    slowest_stats = []
+
+    def write(lines, result):
+        results, stats = result
+        write_chunk(file_out, lines, results)
+        slowest_stats[:] = nlargest(slowest, slowest_stats + stats, key=lambda x: x['total_ms'])
+
+    with open(output_file, 'w', buffering=1 << 20) as file_out:
+        chunks = progress(read_chunks(input_file, chunk), unit='chunk')
+        if processes <= 1:
+            for lines in chunks:
+                write(lines, decode(lines, slowest))
+        else:
+            with get_context('fork').Pool(processes) as pool:
+                # 最多同时有 2 * processes 块在处理，按输入顺序写出
+                pending = deque()
+                for lines in chunks:
+                    pending.append((lines, pool.apply_async(decode, (lines, slowest))))
+                    if len(pending) >= 2 * processes:
+                        lines, result = pending.popleft()
+                        write(lines, result.get())
+                while pending:
+                    lines, result = pending.popleft()
+                    write(lines, result.get())
+    if slowest_stats:
+        import json
+        for stats in slowest_stats:
+            print(json.dumps(stats, ensure_ascii=False), file=sys.stderr)
+
+
+def run_stream(input_file, output_file):
+    file_in = sys.stdin if input_file == '-' else open(input_file)
+    file_out = sys.stdout if output_file == '-' else open(output_file, 'w')
+    try:
+        stream(file_in, file_out)
+    except BrokenPipeError:
+        # 下游（比如 head）提前退出时安静地结束，退出时的刷新也写到 /dev/null
+        import os
+        os.dup2(os.open(os.devnull, os.O_WRONLY), file_out.fileno())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for file in (file_in, file_out):
+            if file not in (sys.stdin, sys.stdout):
+                file.close()
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        usage()
+    parser = ArgumentParser(description='拼音输入法：把输入文件中每行的拼音转换为汉字')
+    parser.add_argument('input_file', nargs='?', default='-', help='path/to/input_file, - for stdin (default)')
+    parser.add_argument('output_file', nargs='?', default='-', help='path/to/output_file, - for stdout (default)')
+    parser.add_argument('-m', '--model', choices=models.MODELS, default='trigram', help='model to use')
+    parser.add_argument('--model-path', help='model database, src/<model>.sqlite3 by default')
+    parser.add_argument('-j', '--processes', type=int, default=1, help='number of decoding processes')
+    parser.add_argument('--chunk', type=int, default=1000, help='lines per chunk')
+    parser.add_argument('--slowest', type=int, default=0, metavar='N',
+                        help='dump decoding stats of the slowest N lines to stderr')
+    args = parser.parse_args()
+    _model_name, _model_path = args.model, args.model_path
+    if '-' in (args.input_file, args.output_file):
+        # 流式模式逐行处理，不分块也不开进程
+        if args.processes > 1 or args.slowest:
+            parser.error('-j and --slowest need an input file and an output file, not "-"')
+        run_stream(args.input_file, args.output_file)
     else:
-        main(sys.argv[1], sys.argv[2])
+        main(args.input_file, args.output_file, args.processes, args.chunk, args.slowest)
@@ -1,36 +1,24 @@
-import os
-from . import settings, models
-from tqdm import tqdm
+from time import perf_counter
+from . import settings, models, tuning
 from functools import reduce
 
 
-def run_batch():
-    for i in range(3, 7):
-        for j in range(16, 20):
-            script = """tmux new-window "
-            export INPUT_METHOD_SMOOTH_1=0.%02d;
-            export INPUT_METHOD_SMOOTH_2=0.%02d;
-            python benchmark.py > result/%d_%d;
-            "
-            """ % (i, j, i, j)
-            os.system(script)
+def run_batch(processes=1):
+    grid = [(i / 100, j / 100, 1 - i / 100 - j / 100) for i in range(3, 7) for j in range(16, 20)]
+    tuning.grid_search(models.TrigramModel(), settings.input_file, settings.answer_file, grid,
+                       'result/trigram.tsv', processes)
 
 
-def run_batch_binary():
-    for i in range(100, 68, -2):
-        script = """tmux new-window "
-        export INPUT_METHOD_SMOOTH=%.2f;
-        export USE_BINARY_MODEL=1;
-        python benchmark.py > result/%d;
-        "
-        """ % (i / 100, i)
-        os.system(script)
+def run_batch_binary(processes=1):
+    grid = [(i / 100, 1 - i / 100) for i in range(100, 68, -2)]
+    tuning.grid_search(models.PinyinBinaryModel(), settings.input_file, settings.answer_file, grid,
+                       'result/binary.tsv', processes)
 
 
 def main(file_in, file_answer, model_class):
     model = model_class()
     inputs = [line.strip() for line in open(file_in) if line.strip()]
-    results = [model.predict(line) for line in tqdm(inputs)]
+    results = model.predict_many(inputs, default='')
     answers = [line.strip() for line in open(file_answer) if line.strip()]
     char_count, char_correct = 0, 0
     line_count, line_correct = len(results), 0
@@ -44,6 +32,22 @@ def main(file_in, file_answer, model_class):
         print(model.smooth, char_correct / char_count, line_correct / line_count)
 
 
+def compare_viterbi(file_in, model_class, min_length=20):
+    """
+    Report speedup of the numpy viterbi engine over the python one on sentences of at least min_length syllables
+    """
+    model = model_class()
+    inputs = [line.strip() for line in open(file_in) if len(line.split()) >= min_length]
+    engine, cost, outputs = model.viterbi, [], []
+    for model.viterbi in (None, engine):
+        now = perf_counter()
+        outputs.append([model.predict(line) for line in inputs])
+        cost.append(perf_counter() - now)
+    model.viterbi = engine
+    assert outputs[0] == outputs[1], 'numpy viterbi gives different outputs'
+    print(len(inputs), 'sentences, python', cost[0], 's, numpy', cost[1], 's, speedup', cost[0] / cost[1])
+
+
 if __name__ == '__main__':
     main(settings.input_file, settings.answer_file,
          models.PinyinBinaryModel if settings.use_binary else models.TrigramModel)
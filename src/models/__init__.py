@@ -1,3 +1,39 @@
-from .naive.models import NaiveBinaryModel
-from .heteronym.models import PinyinBinaryModel
-from .trigram.models import TrigramModel
+"""
+Registry of the models, the module of a model is only imported when the model is used
+
+models.TrigramModel and the like still work, they are resolved on first access (PEP 562),
+so using one model does not import the others nor their dependencies such as numpy.
+"""
+from importlib import import_module
+
+MODELS = {
+    'naive': ('.naive.models', 'NaiveBinaryModel'),
+    'pinyin': ('.heteronym.models', 'PinyinBinaryModel'),
+    'trigram': ('.trigram.models', 'TrigramModel'),
+}
+_MODULES = {class_name: module for module, class_name in MODELS.values()}
+
+
+def model_class(name: str):
+    """
+    Return the model class registered as name
+    """
+    module, class_name = MODELS[name]
+    return getattr(import_module(module, __name__), class_name)
+
+
+def build_module(name: str):
+    """
+    Return the build module of the model registered as name, which imports pypinyin and tqdm
+    """
+    return import_module(MODELS[name][0].replace('.models', '.build'), __name__)
+
+
+def __getattr__(name):
+    if name in _MODULES:
+        return getattr(import_module(_MODULES[name], __name__), name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_MODULES))
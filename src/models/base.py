@@ -0,0 +1,376 @@
+from collections import defaultdict
+from heapq import nlargest
+from math import log, inf
+from operator import itemgetter
+from time import perf_counter
+
+from utils.exception import StrangePinyinError, NoPathError
+from utils.segment import SyllableTrie
+
+
+class BaseModel:
+    """
+    Decoding shared by all models, a model provides:
+        _start_state()                      lattice state before the first syllable
+        _next_state(last_state, syllable)   lattice state after one more syllable
+        _finish(states)                     best sentence for the list of states, without modifying them
+    and for the generic decoders such as predict_kbest and pinyin without spaces:
+        _vocabulary()                       every syllable of the model
+        _candidates(syllable)               char ids of the syllable
+        _start_key(), _stop_steps()         lattice key before the first syllable, candidates after the last one
+        _key_char(key)                      char id of a lattice key
+        _edges(prev_keys, candidates)       yield (key, prev_key, components) of every transition
+        _weights()                          transition probability is sum(weight * component)
+    and for observe():
+        _tables()                           (owner, attribute) of every table whose lookups are counted
+        _step_stats(last_state, state, candidates)
+                                            (states created, states kept) of a step
+    and may override _lattice_step(last_scores, syllable, candidates) and _kbest_edges(prev_keys, syllable,
+    candidates) with faster versions of the generic ones, _kbest_keep(scores, syllable) to prune k-best,
+    _lattice_stats(state) like _step_stats for a lattice step, and _cache_stats() {name: running count}
+    of its caches.
+    """
+    # Called with the stats of every predict when set, see observe()
+    observer = None
+    # Built on first use from _vocabulary()
+    trie = None
+    # Whether _candidates() also takes prefixes of syllables, for abbreviated pinyin such as "zg"
+    abbreviated = False
+
+    def _vocabulary(self):
+        return self.table.keys()
+
+    def _segment(self, pinyin: str):
+        """
+        Return (syllables, None) if pinyin has only one segmentation, or else (None, lattice)
+        """
+        if self.trie is None:
+            self.trie = SyllableTrie(self._vocabulary(), self.abbreviated)
+        return self.trie.segment(pinyin)
+
+    def _syllables(self, pinyin: str):
+        syllables, lattice = self._segment(pinyin)
+        if syllables is None:
+            syllables = self._decode_lattice(lattice)[1]
+        return syllables
+
+    def _tables(self):
+        return ()
+
+    def _lattice_stats(self, state):
+        return len(state), len(state)
+
+    def _cache_stats(self):
+        return {}
+
+    def observe(self, callback=None):
+        """
+        Call callback(stats) after every predict, or stop observing if callback is None,
+        the tables are wrapped by CountedTable while observing
+        """
+        if callback is not None and self.observer is None:
+            self._lookups = [0]
+            for owner, name in self._tables():
+                setattr(owner, name, CountedTable(getattr(owner, name), self._lookups))
+        elif callback is None and self.observer is not None:
+            for owner, name in self._tables():
+                setattr(owner, name, getattr(owner, name).table)
+        self.observer = callback
+
+    def predict(self, pinyin: str):
+        if self.observer is not None:
+            return self._observed_predict(pinyin)
+        syllables, lattice = self._segment(pinyin)
+        if syllables is None:
+            return self._decode_lattice(lattice)[0]
+        states = [self._start_state()]
+        for each in syllables:
+            states.append(self._next_state(states[-1], each))
+        return self._finish(states)
+
+    def _lattice_step(self, last_scores: dict, syllable, candidates):
+        """
+        Return {key: (score, prev_key)} of the best edge into every key from last_scores {prev_key: score},
+        syllable is None for the steps after the last syllable
+        """
+        weights = self._weights()
+        state = {}
+        for key, prev_key, components in self._edges(list(last_scores), candidates):
+            p = sum(weight * component for weight, component in zip(weights, components))
+            if p == 0:
+                continue
+            score = last_scores[prev_key] + log(p)
+            if score > state.get(key, (-inf,))[0]:
+                state[key] = score, prev_key
+        return state
+
+    def _decode_lattice(self, lattice: list):
+        """
+        Return (sentence, syllables) of the best path over every segmentation and every char in one pass,
+        position j keeps for every lattice key its best score over all syllables ending at j with the back
+        pointer (previous position, previous key, syllable), which is enough as the model only sees chars
+        """
+        return self._lattice_backtrace(len(lattice), *self._lattice_forward(lattice))
+
+    def _lattice_forward(self, lattice: list, stats=None):
+        """
+        Return (scores, back) of every position, stats of every syllable step are added to stats if given
+        """
+        length = len(lattice)
+        steps = [list(edges) for edges in lattice]
+        for index, candidates in enumerate(self._stop_steps()):
+            steps.append([(length + index + 1, candidates)])
+        scores = [{} for _ in range(len(steps) + 1)]
+        back = [{} for _ in range(len(steps) + 1)]
+        scores[0][self._start_key()] = 0.0
+        for position, edges in enumerate(steps):
+            last_scores = scores[position]
+            if not last_scores:
+                continue
+            for end, syllable in edges:
+                if end <= length:
+                    candidates = self._candidates(syllable)
+                else:
+                    syllable, candidates = None, syllable
+                state, pointers = scores[end], back[end]
+                step = self._lattice_step(last_scores, syllable, candidates)
+                if stats is not None and syllable is not None:
+                    created, kept = self._lattice_stats(step)
+                    stats['candidates'].append(len(candidates))
+                    stats['states'].append(created)
+                    stats['pruned'].append(created - kept)
+                for key, (score, prev_key) in step.items():
+                    if score > state.get(key, -inf):
+                        state[key] = score
+                        pointers[key] = position, prev_key, syllable
+                if end > length and not state:
+                    # The model has not seen the sentence end, so it tells nothing
+                    state.update(last_scores)
+                    pointers.update((key, (position, key, None)) for key in last_scores)
+        return scores, back
+
+    def _lattice_backtrace(self, length: int, scores: list, back: list):
+        if not scores[-1]:
+            raise NoPathError(self.chars[self._stop_steps()[-1][0]])
+        position = len(scores) - 1
+        key = max(scores[position], key=scores[position].get)
+        chars, syllables = [], []
+        while position:
+            prev_position, prev_key, syllable = back[position][key]
+            if position <= length:
+                chars.append(self.chars[self._key_char(key)])
+                syllables.append(syllable)
+            position, key = prev_position, prev_key
+        return ''.join(reversed(chars)), syllables[::-1]
+
+    def _observed_predict(self, pinyin: str):
+        stats = {
+            'pinyin': pinyin,
+            'candidates': [],
+            'states': [],
+            'pruned': [],
+            'lookups': 0,
+        }
+        self._lookups[0] = 0
+        caches = self._cache_stats()
+        now = perf_counter()
+        syllables, lattice = self._segment(pinyin)
+        stats['lattice'] = syllables is None
+        if syllables is None:
+            # Decoded once over the lattice, which also gives the syllables
+            scores, back = self._lattice_forward(lattice, stats)
+            forward = perf_counter()
+            stats['result'], stats['syllables'] = self._lattice_backtrace(len(lattice), scores, back)
+        else:
+            stats['syllables'] = syllables
+            states = [self._start_state()]
+            for each in syllables:
+                states.append(self._next_state(states[-1], each))
+                candidates = self._candidates(each)
+                created, kept = self._step_stats(states[-2], states[-1], candidates)
+                stats['candidates'].append(len(candidates))
+                stats['states'].append(created)
+                stats['pruned'].append(created - kept)
+            forward = perf_counter()
+            stats['result'] = self._finish(states)
+        backtrace = perf_counter()
+        stats['lookups'] = self._lookups[0]
+        stats.update((name, count - caches[name]) for name, count in self._cache_stats().items())
+        stats['forward_ms'] = (forward - now) * 1000
+        stats['backtrace_ms'] = (backtrace - forward) * 1000
+        stats['total_ms'] = (backtrace - now) * 1000
+        self.observer(stats)
+        return stats['result']
+
+    def _kbest_edges(self, prev_keys, syllable, candidates):
+        """
+        Yield (key, prev_key, log p) of every transition with p > 0, syllable is None after the last syllable
+        """
+        weights = self._weights()
+        for key, prev_key, components in self._edges(prev_keys, candidates):
+            p = sum(weight * component for weight, component in zip(weights, components))
+            if p:
+                yield key, prev_key, log(p)
+
+    def _kbest_keep(self, scores: dict, syllable):
+        """
+        Return the keys of scores {key: best score} kept after the step of syllable, the model prunes as it
+        does for predict
+        """
+        return scores
+
+    def predict_kbest(self, pinyin: str, k=5):
+        """
+        Return up to k (sentence, log probability) best first, in one forward pass which keeps the top k
+        back pointers (score, prev_key, prev_rank) of every lattice key
+        """
+        syllables = self._syllables(pinyin)
+        steps = [(each, self._candidates(each)) for each in syllables] + \
+                [(None, candidates) for candidates in self._stop_steps()]
+        states = [{self._start_key(): [(0.0, None, 0)]}]
+        best = {self._start_key(): 0.0}
+        for syllable, candidates in steps:
+            last_state = states[-1]
+            edges = defaultdict(list)
+            for key, prev_key, p in self._kbest_edges(list(best), syllable, candidates):
+                edges[key].append((best[prev_key] + p, prev_key, p))
+            state = {}
+            for key, each in edges.items():
+                # Only the prev keys with one of the k best scores through them can give the k best of key
+                entries = [(score + p, prev_key, rank) for _, prev_key, p in nlargest(k, each, key=itemgetter(0))
+                           for rank, (score, _, _) in enumerate(last_state[prev_key])]
+                state[key] = nlargest(k, entries, key=itemgetter(0))
+            if syllable is None and not state:
+                # The model has not seen the sentence end, so it tells nothing
+                state = {key: [(score, key, rank) for rank, (score, _, _) in enumerate(entries)]
+                         for key, entries in last_state.items()}
+            best = {key: entries[0][0] for key, entries in state.items()}
+            best = {key: best[key] for key in self._kbest_keep(best, syllable)}
+            states.append({key: state[key] for key in best})
+        ends = nlargest(k, ((entry[0], key, rank) for key, entries in states[-1].items()
+                            for rank, entry in enumerate(entries)), key=lambda x: x[0])
+        results = []
+        for score, key, rank in ends:
+            chars = []
+            for index in range(len(states) - 1, 0, -1):
+                if index <= len(syllables):
+                    chars.append(self.chars[self._key_char(key)])
+                _, key, rank = states[index][key][rank]
+            results.append((''.join(reversed(chars)), score))
+        return results
+
+    def session(self):
+        return DecodeSession(self)
+
+    def predict_many(self, lines, default=None):
+        """
+        Decode lines and reuse the states of shared syllable prefixes, lines with strange pinyin give default
+
+        Lines are visited in the order of their syllables, which is a depth first walk of the prefix trie,
+        so only the states along the current trie path are kept. Lines with several segmentations are
+        decoded over their own lattice.
+        """
+        results = [default] * len(lines)
+        syllables = {}
+        for index, line in enumerate(lines):
+            try:
+                each, lattice = self._segment(line)
+                if each is None:
+                    results[index] = self._decode_lattice(lattice)[0]
+                else:
+                    syllables[index] = tuple(each)
+            except StrangePinyinError:
+                continue
+        path, states = [], [self._start_state()]
+        for index in sorted(syllables, key=syllables.__getitem__):
+            current = syllables[index]
+            shared = 0
+            for each, last in zip(current, path):
+                if each != last:
+                    break
+                shared += 1
+            del path[shared:], states[shared + 1:]
+            try:
+                for each in current[shared:]:
+                    states.append(self._next_state(states[-1], each))
+                    path.append(each)
+                results[index] = self._finish(states)
+            except StrangePinyinError:
+                continue
+        return results
+
+
+class DecodeSession:
+    """
+    Stateful decoding for interactive input, the lattice is kept between keystrokes,
+    so each pushed syllable costs one lattice step plus the backtrace
+    """
+
+    def __init__(self, model: BaseModel):
+        self.model = model
+        self.syllables = []
+        self.states = [model._start_state()]
+        self._best = None
+
+    def __len__(self):
+        return len(self.syllables)
+
+    def push(self, syllable: str):
+        """
+        Raise StrangePinyinError and keep the session unchanged if the syllable can not be decoded
+        """
+        syllable = syllable.lower()
+        self.states.append(self.model._next_state(self.states[-1], syllable))
+        self.syllables.append(syllable)
+        self._best = None
+
+    def pop(self):
+        if self.syllables:
+            self.syllables.pop()
+            self.states.pop()
+            self._best = None
+
+    def best(self):
+        if self._best is None:
+            self._best = self.model._finish(self.states)
+        return self._best
+
+    def commit(self):
+        """
+        Return the best sentence and start over
+        """
+        result = self.best()
+        del self.syllables[:], self.states[1:]
+        self._best = None
+        return result
+
+
+class CountedTable:
+    """
+    Table of an observed model counting every lookup into it, and into the buckets it returns
+    """
+    __slots__ = ('table', 'counter')
+
+    def __init__(self, table, counter: list):
+        self.table = table
+        self.counter = counter
+
+    def _wrap(self, value):
+        return CountedTable(value, self.counter) if hasattr(value, 'get') else value
+
+    def get(self, key, default=None):
+        self.counter[0] += 1
+        return self._wrap(self.table.get(key, default))
+
+    def __getitem__(self, key):
+        self.counter[0] += 1
+        return self._wrap(self.table[key])
+
+    def __len__(self):
+        return len(self.table)
+
+    def __iter__(self):
+        return iter(self.table)
+
+    def items(self):
+        return self.table.items()
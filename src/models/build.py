@@ -0,0 +1,124 @@
+"""
+Build several models in one pass over the corpus
+
+Every document is read and parsed once and fed to the counters of each requested model, and its pinyin
+notation is computed once for both PinyinBinaryModel and TrigramModel. A pinyin model with a fresh corpus
+cache counts from the cache instead, otherwise its cache is written during the pass.
+Usage: python -m models.build [data] [--models naive pinyin trigram]
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+
+import settings
+from utils import corpus, ingest
+from .naive import build as naive
+from .heteronym import build as heteronym
+from .trigram import build as trigram
+
+MODEL_PATHS = {
+    'naive': 'naive.sqlite3',
+    'pinyin': 'pinyin.sqlite3',
+    'trigram': 'trigram.sqlite3',
+}
+
+PINYIN_BUILDS = {
+    'pinyin': heteronym,
+    'trigram': trigram,
+}
+
+
+def _naive_builder(path: Path, model_path: str):
+    """
+    Return (feed(data, notations), close(complete)) of NaiveBinaryModel
+    """
+    connection, char_to_index, record, binary_record = naive.prepare(path, model_path)
+
+    def feed(data, notations):
+        naive.deal_text(data['title'], char_to_index, record, binary_record)
+        naive.deal_text(data['html'], char_to_index, record, binary_record)
+
+    def close(complete):
+        naive.finish(connection, record, binary_record)
+
+    return feed, close
+
+
+def _pinyin_builder(name: str, path: Path, model_path: str):
+    """
+    Return (feed(data, notations), close(complete)) of a pinyin model, feed is None if it counted from cache
+    """
+    build = PINYIN_BUILDS[name]
+    # Only TrigramModel records the ingested files, so that new files can be added into it later
+    entries = ingest.pending(model_path, corpus.corpus_files(path)) if name == 'trigram' else ()
+
+    def ledger(complete):
+        return {'entries': entries if complete else ()} if entries else {}
+
+    connection, pinyin_char_table, *counters = build.prepare(path, model_path)
+    start, stop = len(pinyin_char_table) + 1, len(pinyin_char_table) + 2
+    cache_path = corpus.cache_file(path, name)
+    digest = corpus.fingerprint(path, *build.RULES)
+    ids = corpus.load(cache_path, digest) if settings.corpus_cache else None
+    if ids is not None:
+        print('Reading corpus cache', cache_path)
+        build.count_ids(ids, start, stop, *counters)
+        return None, lambda complete: build.finish(model_path, connection, *counters, **ledger(complete))
+    writer = corpus.Writer(cache_path, digest) if settings.corpus_cache else None
+
+    def feed(data, notations):
+        ids = build.annotate_document(data, pinyin_char_table, notations)
+        if writer:
+            writer.write(ids)
+        build.count_ids(ids, start, stop, *counters)
+
+    def close(complete):
+        if writer:
+            writer.close(complete)
+        build.finish(model_path, connection, *counters, **ledger(complete))
+
+    return feed, close
+
+
+def train_all(path: str, model_paths: dict):
+    """
+    model_paths maps the names in MODEL_PATHS to the database to build
+    """
+    now = datetime.now()
+    path = Path(path)
+    existing = [model_path for model_path in model_paths.values() if Path(model_path).exists()]
+    if existing:
+        raise FileExistsError('%s already exist, add new corpus files into a trigram model with '
+                              'python -m models.trigram.build' % ', '.join(existing))
+    builders = [(name, _naive_builder(path, model_path) if name == 'naive' else
+                 _pinyin_builder(name, path, model_path)) for name, model_path in model_paths.items()]
+    feeds = [feed for name, (feed, close) in builders if feed]
+    notating = any(feed and name in PINYIN_BUILDS for name, (feed, close) in builders)
+    complete = False
+    try:
+        if feeds:
+            for data in corpus.read_data(path):
+                notations = (trigram.notate(data['title']), trigram.notate(data['html'])) if notating \
+                    else (None, None)
+                for feed in feeds:
+                    feed(data, notations)
+        complete = True
+    except KeyboardInterrupt:
+        # Stop reading, but still write what is counted, the corpus caches are dropped
+        pass
+    for name, (feed, close) in builders:
+        close(complete)
+    print(datetime.now(), 'Finished building', ', '.join(model_paths), 'cost',
+          (datetime.now() - now).total_seconds(), 's')
+
+
+def main():
+    parser = ArgumentParser(description='Build models in one pass over the corpus')
+    parser.add_argument('data', nargs='?', default='data', help='directory of table.txt, charset.txt and corpus')
+    parser.add_argument('--models', nargs='+', choices=MODEL_PATHS, default=list(MODEL_PATHS))
+    args = parser.parse_args()
+    train_all(args.data, {name: MODEL_PATHS[name] for name in args.models})
+
+
+if __name__ == '__main__':
+    main()
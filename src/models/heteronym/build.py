@@ -1,13 +1,17 @@
 
 import sqlite3
-import json
+from array import array
 from pathlib import Path
 from collections import defaultdict
+from datetime import datetime
 
+import pypinyin
 from pypinyin import lazy_pinyin, STYLE_NORMAL, load_single_dict, load_phrases_dict
-from tqdm import tqdm
 
 import settings
+from utils import corpus
+from utils.corpus import read_data
+from utils.bulk import tune_for_bulk, merge_counts
 
 REGULAR_PINYIN = {
     'lve': 'lue',
@@ -22,6 +26,9 @@ FORCE_PINYIN = {
     '寻': 'xun',
 }
 
+# Everything changing the annotation of the corpus cache
+RULES = (REGULAR_PINYIN, FORCE_PINYIN, pypinyin.__version__)
+
 
 def create_raw_table(connection: sqlite3.Connection):
     if not connection:
@@ -65,33 +72,23 @@ def read_pinyin(connection: sqlite3.Connection, path: Path):
     return pinyin_table, pinyin_char_table
 
 
-def read_data(path):
-    keyword = settings.key
-    for file in path.iterdir():
-        if keyword not in str(file):
-            continue
-        bar = tqdm(open(file, encoding='gbk'))
-        bar.set_description(str(file))
-        for line in bar:
-            yield json.loads(line)
-
-
 def regularize_relation(relation: dict):
     for key, value in relation.items():
         relation[key] = dict(sorted(value.items(), key=lambda x: x[1], reverse=True)[:100])
 
 
 def insert_result(connection: sqlite3.Connection, record: dict, binary_record: dict):
+    tune_for_bulk(connection)
+    start = datetime.now()
     with connection:
         sql = 'UPDATE char_set SET count=count+? WHERE oid=?'
         connection.executemany(sql, ((count, index) for index, count in record.items()))
-    print('Finished word record insertion')
+    print('Finished word record insertion in', (datetime.now() - start).total_seconds(), 's')
+    start = datetime.now()
     with connection:
-        sql = 'INSERT OR IGNORE INTO relation values (?, ?, 0) '
-        connection.executemany(sql, ((l, r) for l, d in binary_record.items() for r, c in d.items()))
-        sql = 'UPDATE relation SET count=count+? where left=? and right=?'
-        connection.executemany(sql, ((c, l, r) for l, d in binary_record.items() for r, c in d.items()))
-    print('Finished relation insertion')
+        merge_counts(connection, 'relation', ('left', 'right'),
+                     ((l, r, c) for l, d in binary_record.items() for r, c in d.items()))
+    print('Finished relation insertion in', (datetime.now() - start).total_seconds(), 's')
 
 
 def register_pinyin():
@@ -108,11 +105,17 @@ def register_pinyin():
     load_phrases_dict(phrases_dict)
 
 
-def deal_text(text: str, pinyin_char_table: dict, record: dict, binary_record: dict):
+def notate(text: str):
+    return lazy_pinyin(text, style=STYLE_NORMAL, errors=lambda x: [None] * len(x))
+
+
+def annotate(text: str, pinyin_char_table: dict, notation=None):
+    """
+    Return char_set ids of text, a char out of the table is start
+    """
     start = len(pinyin_char_table) + 1
-    stop = len(pinyin_char_table) + 2
-    left = start
-    notation = lazy_pinyin(text, style=STYLE_NORMAL, errors=lambda x: [None] * len(x))
+    ids = []
+    notation = notation or notate(text)
     for pinyin, char in zip(notation, text):
         if pinyin is None:
             right = start
@@ -122,6 +125,19 @@ def deal_text(text: str, pinyin_char_table: dict, record: dict, binary_record: d
             right = pinyin_char_table.get((pinyin, char), start)
             if right == start:
                 print('WARNING: strang (pinyin, char):', pinyin, char)
+        ids.append(right)
+    return ids
+
+
+def count_ids(ids, start: int, stop: int, record: dict, binary_record: dict):
+    """
+    Count char_set ids of one text, or of many texts each followed by 0 as in the corpus cache
+    """
+    left = start
+    for right in ids:
+        if not right:
+            left = start
+            continue
         record[right] += 1
         if right != start:
             binary_record[left][right] += 1
@@ -131,18 +147,55 @@ def deal_text(text: str, pinyin_char_table: dict, record: dict, binary_record: d
     return
 
 
-def train(path: str, model_path: str):
+def deal_text(text: str, pinyin_char_table: dict, record: dict, binary_record: dict):
+    count_ids(annotate(text, pinyin_char_table), len(pinyin_char_table) + 1, len(pinyin_char_table) + 2,
+              record, binary_record)
+
+
+def annotate_document(data: dict, pinyin_char_table: dict, notations=(None, None)):
+    """
+    Return the id array of a document for the corpus cache, every text ends with 0
+    """
+    ids = array(corpus.typecode(len(pinyin_char_table) + 2))
+    for text, notation in zip((data['title'], data['html']), notations):
+        ids.extend(annotate(text, pinyin_char_table, notation))
+        ids.append(0)
+    return ids
+
+
+def annotate_data(path: Path, pinyin_char_table: dict):
+    for data in read_data(path):
+        yield annotate_document(data, pinyin_char_table)
+
+
+def prepare(path: Path, model_path: str):
+    """
+    Create the database and return (connection, pinyin_char_table, record, binary_record) to count into
+    """
     register_pinyin()
-    path = Path(path)
     connection = not Path(model_path).exists() and sqlite3.connect(model_path)
     create_raw_table(connection)
     pinyin_table, pinyin_char_table = read_pinyin(connection, path)
     record = {i + 1: 0 for i in range(len(pinyin_char_table) + 1)}
     binary_record = {i + 1: defaultdict(int) for i in range(len(pinyin_char_table) + 1)}
-    for data in read_data(path):
-        deal_text(data['title'], pinyin_char_table, record, binary_record)
-        deal_text(data['html'], pinyin_char_table, record, binary_record)
+    return connection, pinyin_char_table, record, binary_record
+
+
+def finish(model_path: str, connection: sqlite3.Connection, record: dict, binary_record: dict):
     regularize_relation(binary_record)
     connection = connection or sqlite3.connect(model_path, timeout=30)
     insert_result(connection, record, binary_record)
     connection.close()
+
+
+def train(path: str, model_path: str):
+    path = Path(path)
+    connection, pinyin_char_table, record, binary_record = prepare(path, model_path)
+    if settings.corpus_cache:
+        ids = corpus.annotated('pinyin', path, lambda: annotate_data(path, pinyin_char_table), *RULES)
+        count_ids(ids, len(pinyin_char_table) + 1, len(pinyin_char_table) + 2, record, binary_record)
+    else:
+        for data in read_data(path):
+            deal_text(data['title'], pinyin_char_table, record, binary_record)
+            deal_text(data['html'], pinyin_char_table, record, binary_record)
+    finish(model_path, connection, record, binary_record)
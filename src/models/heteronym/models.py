@@ -1,13 +1,17 @@
-import sqlite3
 from pathlib import Path
 from collections import defaultdict
 from datetime import datetime
 from sys import stderr
 
 import settings
+from utils.exception import StrangePinyinError
+from utils.load import Loader, relation_dict
+from utils.ngram import PackedRelation
+from utils.viterbi import BinaryViterbi
+from ..base import BaseModel
 
 
-class PinyinBinaryModel:
+class PinyinBinaryModel(BaseModel):
     """
     Naive binary model with viterbi algorithm
     """
@@ -17,7 +21,7 @@ class PinyinBinaryModel:
             try:
                 from sys import stderr
                 from .build import train
-                print('WARNING: no model file at', model_path, 'and try to build model')
+                print('WARNING: no model file at', model_path, 'and try to build model', file=stderr)
                 train('data', model_path)
             except Exception as e:
                 Path(model_path).unlink()
@@ -25,7 +29,7 @@ class PinyinBinaryModel:
         self.smooth = settings.smooth
         self.candidates = settings.candidates
         self.occurrence_bound = settings.occurrence_bound
-        self.connection = sqlite3.connect(model_path)
+        self.loader = Loader(model_path)
         self.char_pinyin = ()
         self.chars = ()
         self.char_to_count = {}
@@ -34,12 +38,15 @@ class PinyinBinaryModel:
         self.table = defaultdict()
         self.pinyin_to_index = {}
         self.char_related_count = {}
+        self.load_timing = {}
         self.initialize()
-        self.connection.close()
+        self.viterbi = None
+        if settings.use_numpy and BinaryViterbi.available():
+            self.viterbi = BinaryViterbi(self.char_to_count, self.char_to_likelihood, self.relation, self.smooth,
+                                         capacity=settings.viterbi_rows)
 
     def _load_charset(self):
-        sql = 'SELECT * from char_set ORDER BY oid'
-        data = self.connection.execute(sql).fetchall()
+        data = self.loader.table('char_set', 'SELECT * from char_set ORDER BY oid')
         self.chars = ('',) + tuple(each[1] for each in data)
         self.char_to_count = (0,) + tuple(each[2] for each in data)
         total_char_count = sum(self.char_to_count[:-2])
@@ -48,16 +55,21 @@ class PinyinBinaryModel:
             self.table.setdefault(pinyin, []).append(index + 1)
 
     def _load_relation(self):
-        sql = 'SELECT left, group_concat(right), group_concat(count) FROM relation GROUP BY left'
-        self.relation = {left: dict(zip(map(int, rights.split(',')), map(int, counts.split(',')))) for
-                         left, rights, counts in self.connection.execute(sql)}
+        sql = 'SELECT left, right, count FROM relation ORDER BY left, right'
+        if settings.use_compact:
+            self.relation = self.loader.table('relation', sql, PackedRelation.from_rows)
+        else:
+            self.relation = self.loader.table('relation', sql, relation_dict)
 
     def initialize(self):
         print('Loading model...', file=stderr)
         now = datetime.now()
         self._load_charset()
         self._load_relation()
-        print('Finished load model, cost ', (datetime.now() - now).total_seconds(), 's', file=stderr)
+        self.loader.close()
+        self.load_timing = self.loader.timing
+        print('Finished load model, cost ', (datetime.now() - now).total_seconds(), 's',
+              '(%s)' % self.loader.report(), file=stderr)
 
     def _update_next_state(self, last_state, state):
         smooth = self.smooth
@@ -71,19 +83,68 @@ class PinyinBinaryModel:
             state[right][0] = max(state[right].values())
         return state
 
-    def predict(self, pinyin: str):
+    def _start_state(self):
+        start = len(self.chars) - 2  # for ^
+        if self.viterbi:
+            return self.viterbi.start_state(start)
+        return {start: {0: 1}}
+
+    def _candidates(self, syllable):
+        candidates = self.table.get(syllable)
+        if not candidates:
+            raise StrangePinyinError(syllable)
+        return candidates
+
+    def _next_state(self, last_state, syllable):
+        candidates = self._candidates(syllable)
+        if self.viterbi:
+            return self.viterbi.next_state(last_state, syllable, candidates)
+        return self._update_next_state(last_state, {current: {} for current in candidates})
+
+    def _lattice_step(self, last_scores, syllable, candidates):
+        if self.viterbi:
+            return self.viterbi.lattice_step(last_scores, syllable, candidates)
+        return super()._lattice_step(last_scores, syllable, candidates)
+
+    def _finish(self, states):
         stop = len(self.chars) - 1  # for $
-        start = stop - 1  # for ^
-        states = [{start: {0: 1}}]
-        for each in pinyin.split():
-            each = each.lower()
-            candidates = self.table.get(each)
-            if not candidates:
-                raise StrangePinyinError(each)
-            states.append(self._update_next_state(states[-1], {current: {} for current in candidates}))
+        if self.viterbi:
+            return ''.join(map(lambda x: self.chars[x], self.viterbi.finish(states, stop)))
         end_state = self._update_next_state(states[-1], {stop: {}})[stop]
-        end_state.pop(0)
-        result = [max(end_state, key=lambda x: end_state[x])]
+        if end_state.pop(0):
+            result = [max(end_state, key=lambda x: end_state[x])]
+        else:
+            # The model has not seen the sentence end, so it tells nothing, as in _decode_lattice
+            result = [max(states[-1], key=lambda x: states[-1][x][0])]
         for state in states[:0:-1]:
             result.append(max(filter(lambda x: x, state[result[-1]]), key=lambda x: state[result[-1]][x]))
         return ''.join(map(lambda x: self.chars[x], reversed(result[:-1])))
+
+    def _start_key(self):
+        return len(self.chars) - 2  # for ^
+
+    def _stop_steps(self):
+        return [[len(self.chars) - 1]]  # for $
+
+    def _key_char(self, key):
+        return key
+
+    def _weights(self):
+        return self.smooth, 1 - self.smooth
+
+    def _edges(self, prev_keys, candidates):
+        for right in candidates:
+            for left in prev_keys:
+                count_left_right = self.relation.get(left, {}).get(right, 0)
+                p2 = count_left_right and count_left_right / self.char_to_count[left]
+                yield right, left, (p2, self.char_to_likelihood[right])
+
+    def _tables(self):
+        return ((self, 'relation'),) + (((self.viterbi, 'relation'),) if self.viterbi else ())
+
+    def _step_stats(self, last_state, state, candidates):
+        kept = len(state[0]) if self.viterbi else len(state)
+        return kept, kept
+
+    def _cache_stats(self):
+        return {'row_hits': self.viterbi.hits, 'row_misses': self.viterbi.misses} if self.viterbi else {}
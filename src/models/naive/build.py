@@ -1,9 +1,8 @@
 import sqlite3
-import json
 from pathlib import Path
 from collections import defaultdict
 
-from tqdm import tqdm
+from utils.corpus import read_data
 
 
 def create_raw_table(connection: sqlite3.Connection):
@@ -62,16 +61,6 @@ def read_pinyin(connection: sqlite3.Connection, path: Path, char_to_index: dict)
     return pinyin_table
 
 
-def read_data(path):
-    for file in path.iterdir():
-        if file.name[:4] != '2016':
-            continue
-        bar = tqdm(open(file, encoding='gbk'))
-        bar.set_description(str(file))
-        for line in bar:
-            yield json.loads(line)
-
-
 def regularize_relation(relation: dict):
     for key, value in relation.items():
         relation[key] = dict(sorted(value.items(), key=lambda x: x[1], reverse=True)[:100])
@@ -104,16 +93,28 @@ def deal_text(text: str, char_to_index: dict, record: dict, binary_record: dict)
     return
 
 
-def train(path: str, model_path: str):
-    path = Path(path)
+def prepare(path: Path, model_path: str):
+    """
+    Create the database and return (connection, char_to_index, record, binary_record) to count into
+    """
     connection = sqlite3.connect(model_path)
     create_raw_table(connection)
     charset, index_to_char = read_charset(connection, path)
     read_pinyin(connection, path, index_to_char)
     record = {i + 1: 0 for i in range(len(charset) + 1)}
     binary_record = {i + 1: defaultdict(int) for i in range(len(charset) + 1)}
+    return connection, index_to_char, record, binary_record
+
+
+def finish(connection: sqlite3.Connection, record: dict, binary_record: dict):
+    insert_result(connection, record, binary_record)
+    connection.close()
+
+
+def train(path: str, model_path: str):
+    path = Path(path)
+    connection, index_to_char, record, binary_record = prepare(path, model_path)
     for data in read_data(path):
         deal_text(data['title'], index_to_char, record, binary_record)
         deal_text(data['html'], index_to_char, record, binary_record)
-    insert_result(connection, record, binary_record)
-    connection.close()
+    finish(connection, record, binary_record)
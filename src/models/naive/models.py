@@ -1,12 +1,19 @@
-import sqlite3
 from pathlib import Path
 from collections import defaultdict
 from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+from sys import stderr
 
 import settings
+from utils.exception import StrangePinyinError
+from utils.load import Loader, relation_dict
+from utils.ngram import PackedRelation
+from utils.viterbi import BinaryViterbi
+from ..base import BaseModel
 
 
-class NaiveBinaryModel:
+class NaiveBinaryModel(BaseModel):
     """
     Naive binary model with viterbi algorithm
     """
@@ -15,14 +22,14 @@ class NaiveBinaryModel:
             try:
                 from sys import stderr
                 from .build import train
-                print('WARNING: no model file at', model_path, 'and try to build model')
+                print('WARNING: no model file at', model_path, 'and try to build model', file=stderr)
                 train('data', model_path)
             except Exception as e:
                 Path(model_path).unlink()
                 raise e
         self.smooth = settings.smooth
         self.candidates = settings.candidates
-        self.connection = sqlite3.connect(model_path)
+        self.loader = Loader(model_path)
         self.chars = ()
         self.char_to_count = {}
         self.char_to_likelihood = {}
@@ -30,42 +37,51 @@ class NaiveBinaryModel:
         self.table = {}
         self.pinyin_to_index = {}
         self.char_related_count = {}
+        self.load_timing = {}
         self.initialize()
-        self.connection.close()
+        self.viterbi = None
+        if settings.use_numpy and BinaryViterbi.available():
+            self.viterbi = BinaryViterbi(self.char_to_count, self.char_to_likelihood, self.relation, self.smooth,
+                                         skip_unseen=True, capacity=settings.viterbi_rows)
 
     def _load_charset(self):
-        sql = 'SELECT * FROM charset ORDER BY oid'
-        data = self.connection.execute(sql).fetchall()
+        data = self.loader.table('charset', 'SELECT * FROM charset ORDER BY oid')
         self.chars = ('', ) + tuple(each[0] for each in data)
         self.char_to_count = (0, ) + tuple(each[1] for each in data)
         total_char_count = sum(self.char_to_count[:-2])
         self.char_to_likelihood = [count / total_char_count for count in self.char_to_count]
 
     def _load_pinyin(self):
-        sql = 'SELECT oid, * FROM pinyin_set ORDER BY oid'
-        data = self.connection.execute(sql).fetchall()
+        data = self.loader.table('pinyin_set', 'SELECT oid, * FROM pinyin_set ORDER BY oid')
         self.pinyin_to_index = {each[1]: each[0] for each in data}
-        for index in self.pinyin_to_index.values():
-            sql = 'SELECT char from pinyin_char WHERE pinyin=%d' % index
-            data = self.connection.execute(sql).fetchall()
-            self.table[index] = sum(data, ())
+        self.table = dict.fromkeys(self.pinyin_to_index.values(), ())
+        sql = 'SELECT pinyin, char FROM pinyin_char ORDER BY pinyin, oid'
+        self.table.update(self.loader.table('pinyin_char', sql, lambda rows: {
+            index: tuple(char for _, char in group) for index, group in groupby(rows, key=itemgetter(0))}))
 
     def _load_relation(self):
+        # The most frequent candidates right chars of every left char, ranked in one scan by a window function
+        sql = 'SELECT left, right, count FROM (' \
+              'SELECT left, right, count, row_number() OVER (PARTITION BY left ORDER BY count DESC) AS rank ' \
+              'FROM relation WHERE count>0) ' \
+              'WHERE rank<=? ORDER BY left, right'
+        if settings.use_compact:
+            self.relation = self.loader.table('relation', sql, PackedRelation.from_rows, self.candidates)
+            return
         for index in range(1, 1 + len(self.chars) + 1):
-            sql = 'SELECT right, count FROM relation ' \
-                  'WHERE left=%d AND count>0 ' \
-                  'ORDER BY count DESC LIMIT %d' % (index, self.candidates)
-            data = self.connection.execute(sql).fetchall()
-            relation = dict(data)
-            self.relation[index] = relation
+            self.relation[index] = {}
+        self.loader.table('relation', sql, lambda rows: relation_dict(rows, self.relation), self.candidates)
 
     def initialize(self):
-        print('Loading model...')
+        print('Loading model...', file=stderr)
         now = datetime.now()
         self._load_charset()
         self._load_pinyin()
         self._load_relation()
-        print('Finished load model, cost ', (datetime.now() - now).total_seconds(), 's')
+        self.loader.close()
+        self.load_timing = self.loader.timing
+        print('Finished load model, cost ', (datetime.now() - now).total_seconds(), 's',
+              '(%s)' % self.loader.report(), file=stderr)
 
     def _update_next_state(self, last_state, state):
         smooth = self.smooth
@@ -80,18 +96,72 @@ class NaiveBinaryModel:
             state[right][0] = max(state[right].values())
         return state
 
-    def predict(self, pinyin: str):
+    def _start_state(self):
+        start = len(self.chars) - 2  # for ^
+        if self.viterbi:
+            return self.viterbi.start_state(start)
+        return {start: {0: 1}}
+
+    def _vocabulary(self):
+        return self.pinyin_to_index.keys()
+
+    def _candidates(self, syllable):
+        index = self.pinyin_to_index.get(syllable)
+        if not index:
+            raise StrangePinyinError(syllable)
+        return self.table[index]
+
+    def _next_state(self, last_state, syllable):
+        candidates = self._candidates(syllable)
+        if self.viterbi:
+            return self.viterbi.next_state(last_state, syllable, candidates)
+        return self._update_next_state(last_state, {current: {} for current in candidates})
+
+    def _lattice_step(self, last_scores, syllable, candidates):
+        if self.viterbi:
+            return self.viterbi.lattice_step(last_scores, syllable, candidates)
+        return super()._lattice_step(last_scores, syllable, candidates)
+
+    def _finish(self, states):
         stop = len(self.chars) - 1  # for $
-        start = stop - 1            # for ^
-        states = [{start: {0: 1}}]
-        for each in pinyin.split():
-            index = self.pinyin_to_index.get(each.lower())
-            if not index:
-                raise StrangePinyinError(each)
-            states.append(self._update_next_state(states[-1], {current: {} for current in self.table[index]}))
+        if self.viterbi:
+            return ''.join(map(lambda x: self.chars[x], self.viterbi.finish(states, stop)))
         end_state = self._update_next_state(states[-1], {stop: {}})[stop]
-        end_state.pop(0)
-        result = [max(end_state, key=lambda x: end_state[x])]
+        if end_state.pop(0):
+            result = [max(end_state, key=lambda x: end_state[x])]
+        else:
+            # The model has not seen the sentence end, so it tells nothing, as in _decode_lattice
+            result = [max(states[-1], key=lambda x: states[-1][x][0])]
         for state in states[:0:-1]:
             result.append(max(filter(lambda x: x, state[result[-1]]), key=lambda x: state[result[-1]][x]))
         return ''.join(map(lambda x: self.chars[x], reversed(result[:-1])))
+
+    def _start_key(self):
+        return len(self.chars) - 2  # for ^
+
+    def _stop_steps(self):
+        return [[len(self.chars) - 1]]  # for $
+
+    def _key_char(self, key):
+        return key
+
+    def _weights(self):
+        return self.smooth, 1 - self.smooth
+
+    def _edges(self, prev_keys, candidates):
+        for right in candidates:
+            for left in prev_keys:
+                if not self.char_to_count[left]:
+                    continue
+                p_related = self.relation[left].get(right, 0) / self.char_to_count[left]
+                yield right, left, (p_related, self.char_to_likelihood[right])
+
+    def _tables(self):
+        return ((self, 'relation'),) + (((self.viterbi, 'relation'),) if self.viterbi else ())
+
+    def _step_stats(self, last_state, state, candidates):
+        kept = len(state[0]) if self.viterbi else len(state)
+        return kept, kept
+
+    def _cache_stats(self):
+        return {'row_hits': self.viterbi.hits, 'row_misses': self.viterbi.misses} if self.viterbi else {}
@@ -0,0 +1,62 @@
+"""
+Transition blocks of adjacent syllable pairs, such as "zhong guo", kept across predictions
+
+For a pair (previous syllable, syllable) the block holds for every previous char mid the row
+(right, base, log(base)) over the candidates of the syllable, where base = smooth_1 * p(right) +
+smooth_2 * p(right | mid) does not depend on the char before mid. Decoding then only adds the trigram
+component for the few rights counted after (left, mid), and takes the precomputed log for all the others.
+"""
+import sys
+import threading
+from collections import OrderedDict
+
+
+class BlockCache:
+    """
+    LRU of {(previous syllable, syllable): {mid: row}}, the least recently used blocks are dropped once
+    there are more than capacity of them
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def get(self, key):
+        """
+        Return the block of key, the decoder adds the row of a mid to it when the mid is first met
+        """
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.hits += 1
+                self.blocks.move_to_end(key)
+                return block
+            self.misses += 1
+            block = self.blocks[key] = {}
+            if len(self.blocks) > self.capacity:
+                self.blocks.popitem(last=False)
+            return block
+
+    @staticmethod
+    def _size(block):
+        return sys.getsizeof(block) + sum(sys.getsizeof(row) + sum(
+            sys.getsizeof(each) + sys.getsizeof(each[1]) + sys.getsizeof(each[2]) for each in row)
+            for row in list(block.values()))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'blocks': len(self.blocks),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            # Measured on demand, rows are added to blocks without the lock
+            'memory_mb': sum(map(self._size, list(self.blocks.values()))) / 2 ** 20,
+        }
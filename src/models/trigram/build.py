@@ -1,14 +1,23 @@
 import sqlite3
 import json
+from array import array
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import datetime
 from bisect import bisect_right
+from multiprocessing import Pool
+from argparse import ArgumentParser
 
-from pypinyin import lazy_pinyin, STYLE_NORMAL
+import pypinyin
+from pypinyin import lazy_pinyin, STYLE_NORMAL, load_single_dict, load_phrases_dict
 from tqdm import tqdm
 
 import settings
+from utils.ngram import pack, unpack
+from utils import corpus, ingest
+from utils.corpus import read_data
+from utils.bulk import tune_for_bulk, merge_counts, merge_sorted
+from utils.spill import Spill
 
 REGULAR_PINYIN = {
     'lve': 'lue',
@@ -23,6 +32,9 @@ FORCE_PINYIN = {
     '寻': 'xun',
 }
 
+# Everything changing the annotation of the corpus cache
+RULES = (REGULAR_PINYIN, FORCE_PINYIN, pypinyin.__version__)
+
 
 def create_raw_table(connection: sqlite3.Connection):
     if not connection:
@@ -79,39 +91,59 @@ def regularize_relation(relation: dict):
         relation[key] = dict(sorted_pair[bisect_right([each[1] for each in sorted_pair], settings.occurrence_bound):])
 
 
-def insert_result(connection: sqlite3.Connection, record: dict, binary_record: dict, ternary_record: dict):
-    start = datetime.now()
+def insert_result(connection: sqlite3.Connection, record: dict, binary_record: dict, ternary_record: dict,
+                  spill=None, entries=()):
+    """
+    Add the counts and record entries from ingest.pending() as ingested in one transaction,
+    so the ledger never claims files whose counts are missing
+    """
+    tune_for_bulk(connection)
     with connection:
+        if entries:
+            ingest.record(connection, entries)
+        start = datetime.now()
         sql = 'UPDATE char_set SET count=count+? WHERE oid=?'
         connection.executemany(sql, ((count, index) for index, count in record.items()))
-    stop = datetime.now()
-    print(stop, 'Finished word record insertion in', (stop - start).total_seconds(), 's')
-    start = datetime.now()
+        stop = datetime.now()
+        print(stop, 'Finished word record insertion in', (stop - start).total_seconds(), 's')
 
-    with connection:
-        sql = 'INSERT OR IGNORE INTO relation2 values (?, ?, 0) '
-        connection.executemany(sql, ((l, r) for l, d in binary_record.items() for r, c in d.items()))
-        sql = 'UPDATE relation2 SET count=count+? where left=? and right=?'
-        connection.executemany(sql, ((c, l, r) for l, d in binary_record.items() for r, c in d.items()))
-    stop = datetime.now()
-    print(stop, 'Finished relation2 insertion in', (stop - start).total_seconds(), 's')
-    start = datetime.now()
+        start = datetime.now()
+        merge_counts(connection, 'relation2', ('left', 'right'),
+                     ((l, r, c) for l, d in binary_record.items() for r, c in d.items()))
+        stop = datetime.now()
+        print(stop, 'Finished relation2 insertion in', (stop - start).total_seconds(), 's')
 
-    with connection:
-        sql = 'INSERT OR IGNORE INTO relation3 values (?, ?, ?, 0) '
-        connection.executemany(sql, ((*k, r) for k, d in ternary_record.items() for r, c in d.items()))
-        sql = 'UPDATE relation3 SET count=count+? where left=? and middle=? and right=?'
-        connection.executemany(sql, ((c, *k, r) for k, d in ternary_record.items() for r, c in d.items()))
-    stop = datetime.now()
-    print(stop, 'Finished relation3 insertion in', (stop - start).total_seconds(), 's')
+        start = datetime.now()
+        if spill is None:
+            merge_counts(connection, 'relation3', ('left', 'middle', 'right'),
+                         ((*k, r, c) for k, d in ternary_record.items() for r, c in d.items()))
+        else:
+            merge_sorted(connection, 'relation3', ('left', 'middle', 'right'), spill.merge(ternary_record))
+        stop = datetime.now()
+        print(stop, 'Finished relation3 insertion in', (stop - start).total_seconds(), 's')
+    if spill is not None:
+        spill.close()
 
 
-def deal_text(text: str, pinyin_char_table: dict, record: dict, binary_record: dict, ternary_record: dict):
+def register_pinyin():
+    """
+    register pypinyin for some special character
+    """
+    load_single_dict({ord('哪'): 'na'})
+    load_phrases_dict({'哪些': [['na'], ['xie']]})
+
+
+def notate(text: str):
+    return lazy_pinyin(text, style=STYLE_NORMAL, errors=lambda x: [None] * len(x))
+
+
+def annotate(text: str, pinyin_char_table: dict, notation=None):
+    """
+    Return char_set ids of text, a char out of the table is start
+    """
     start = len(pinyin_char_table) + 1
-    stop = len(pinyin_char_table) + 2
-    left = start
-    middle = start
-    notation = lazy_pinyin(text, style=STYLE_NORMAL, errors=lambda x: [None] * len(x))
+    ids = []
+    notation = notation or notate(text)
     for pinyin, char in zip(notation, text):
         if pinyin is None:
             right = start
@@ -121,6 +153,22 @@ def deal_text(text: str, pinyin_char_table: dict, record: dict, binary_record: d
             right = pinyin_char_table.get((pinyin, char), start)
             if settings.warning and right == start:
                 print('WARNING: strang (pinyin, char):', pinyin, char)
+        ids.append(right)
+    return ids
+
+
+def count_ids(ids, start: int, stop: int, record: dict, binary_record: dict, ternary_record: dict, spill=None):
+    """
+    Count char_set ids of one text, or of many texts each followed by 0 as in the corpus cache
+    """
+    left = start
+    middle = start
+    for right in ids:
+        if not right:
+            left = middle = start
+            if spill is not None:
+                spill.check(ternary_record)
+            continue
         record[right] += 1
         if right != start:
             ternary_record[(left, middle)][right] += 1
@@ -137,37 +185,156 @@ def deal_text(text: str, pinyin_char_table: dict, record: dict, binary_record: d
     return
 
 
-def read_data(path):
-    keyword = settings.key
-    for file in path.iterdir():
-        if keyword not in str(file):
-            continue
-        cnt = 0
+def deal_text(text: str, pinyin_char_table: dict, record: dict, binary_record: dict, ternary_record: dict):
+    count_ids(annotate(text, pinyin_char_table), len(pinyin_char_table) + 1, len(pinyin_char_table) + 2,
+              record, binary_record, ternary_record)
+
+
+def annotate_document(data: dict, pinyin_char_table: dict, notations=(None, None)):
+    """
+    Return the id array of a document for the corpus cache, every text ends with 0
+    """
+    ids = array(corpus.typecode(len(pinyin_char_table) + 2))
+    for text, notation in zip((data['title'], data['html']), notations):
+        ids.extend(annotate(text, pinyin_char_table, notation))
+        ids.append(0)
+    return ids
+
+
+def read_chunks(path, size=2000, files=None):
+    """
+    Same files as read_data, but yield raw lines in chunks for worker processes
+    """
+    for file in corpus.corpus_files(path) if files is None else files:
+        chunk = []
         bar = tqdm(open(file, encoding='gbk'))
         bar.set_description(str(file))
-        for line in bar:
-            yield json.loads(line)
-            cnt += 1
+        for cnt, line in enumerate(bar):
             if settings.debug and cnt > 2000:
                 break
+            chunk.append(line)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+_pinyin_char_table = None
 
 
-def train(path: str, model_path: str):
+def _init_worker(pinyin_char_table: dict):
+    global _pinyin_char_table
+    register_pinyin()
+    _pinyin_char_table = pinyin_char_table
+
+
+def _count_chunk(lines: list):
+    """
+    Count a chunk in worker, return flat arrays in first-seen order so that merging keeps the serial order
+    """
+    record = defaultdict(int)
+    binary_record = defaultdict(lambda: defaultdict(int))
+    ternary_record = defaultdict(lambda: defaultdict(int))
+    for line in lines:
+        data = json.loads(line)
+        deal_text(data['title'], _pinyin_char_table, record, binary_record, ternary_record)
+        deal_text(data['html'], _pinyin_char_table, record, binary_record, ternary_record)
+    record = array('q', record.keys()), array('q', record.values())
+    binary = array('q'), array('q')
+    for left, rights in binary_record.items():
+        for right, count in rights.items():
+            binary[0].append(pack(left, right))
+            binary[1].append(count)
+    ternary = array('q'), array('q'), array('q')
+    for key, rights in ternary_record.items():
+        for right, count in rights.items():
+            ternary[0].append(pack(*key))
+            ternary[1].append(right)
+            ternary[2].append(count)
+    return record, binary, ternary
+
+
+def _merge_chunk(result, record: dict, binary_record: dict, ternary_record: dict):
+    (indexes, counts), (binary_keys, binary_counts), (ternary_keys, rights, ternary_counts) = result
+    for index, count in zip(indexes, counts):
+        record[index] += count
+    for key, count in zip(binary_keys, binary_counts):
+        left, right = unpack(key)
+        binary_record[left][right] += count
+    for key, right, count in zip(ternary_keys, rights, ternary_counts):
+        ternary_record[unpack(key)][right] += count
+
+
+def _annotate_chunk(lines: list):
+    ids = array(corpus.typecode(len(_pinyin_char_table) + 2))
+    for line in lines:
+        ids.extend(annotate_document(json.loads(line), _pinyin_char_table))
+    return ids
+
+
+def annotate_data(path: Path, pinyin_char_table: dict, processes=1):
+    """
+    Yield id arrays of the corpus for the corpus cache, annotated by a process pool if processes > 1
+    """
+    if processes <= 1:
+        for data in read_data(path):
+            yield annotate_document(data, pinyin_char_table)
+        return
+    with Pool(processes, _init_worker, (pinyin_char_table,)) as pool:
+        pending = deque()
+        for chunk in read_chunks(path):
+            pending.append(pool.apply_async(_annotate_chunk, (chunk,)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def parallel_count(path: Path, pinyin_char_table: dict, processes: int,
+                   record: dict, binary_record: dict, ternary_record: dict, spill=None, files=None):
+    """
+    Count the corpus with a process pool, chunks are merged in order so the result equals the serial one
+    """
+    with Pool(processes, _init_worker, (pinyin_char_table,)) as pool:
+        pending = deque()
+        try:
+            for chunk in read_chunks(path, files=files):
+                pending.append(pool.apply_async(_count_chunk, (chunk,)))
+                if len(pending) >= 2 * processes:
+                    _merge_chunk(pending.popleft().get(), record, binary_record, ternary_record)
+                    if spill is not None:
+                        spill.check(ternary_record, 2 * len(chunk))
+        finally:
+            # Even when interrupted, still merge the chunks already sent
+            while pending:
+                _merge_chunk(pending.popleft().get(), record, binary_record, ternary_record)
+                if spill is not None:
+                    spill.check(ternary_record, 2 * len(chunk))
+
+
+def prepare(path: Path, model_path: str):
+    """
+    Create the database if it does not exist,
+    return (connection, pinyin_char_table, record, binary_record, ternary_record, spill) to count into,
+    spill is None unless BUILD_MEMORY_MB caps the memory of ternary_record
+    """
     register_pinyin()
-    path = Path(path)
     connection = not Path(model_path).exists() and sqlite3.connect(model_path)
     create_raw_table(connection)
     pinyin_table, pinyin_char_table = read_pinyin(connection, path)
     record = {i + 1: 0 for i in range(len(pinyin_char_table) + 1)}
     binary_record = {i + 1: defaultdict(int) for i in range(len(pinyin_char_table) + 1)}
     ternary_record = defaultdict(lambda: defaultdict(int))
-    try:
-        for data in read_data(path):
-            deal_text(data['title'], pinyin_char_table, record, binary_record, ternary_record)
-            deal_text(data['html'], pinyin_char_table, record, binary_record, ternary_record)
-    except KeyboardInterrupt:
-        # Meet keyboard interrupt firstly, just stop read_data
-        pass
+    spill = Spill(settings.build_memory, path) if settings.build_memory else None
+    return connection, pinyin_char_table, record, binary_record, ternary_record, spill
+
+
+def finish(model_path: str, connection: sqlite3.Connection, record: dict, binary_record: dict,
+           ternary_record: dict, spill=None, entries=()):
+    """
+    Add the counts into the database, entries are the ingest.pending() files which were counted
+    """
     # Just wait until connect successfully
     print(datetime.now(), 'Try to get lock')
     while not connection:
@@ -176,6 +343,72 @@ def train(path: str, model_path: str):
         except sqlite3.OperationalError as e:
             print(datetime.now(), e)
             continue
-    insert_result(connection, record, binary_record, ternary_record)
+    insert_result(connection, record, binary_record, ternary_record, spill, entries)
     connection.close()
     print(datetime.now(), 'Release lock')
+
+
+def train(path: str, model_path: str, processes=settings.processes, force=False):
+    """
+    Count the corpus files under path which are not counted into model_path yet, and add them into it,
+    force counts every file into a model which has no ledger
+    """
+    path = Path(path)
+    files = corpus.corpus_files(path)
+    existed = Path(model_path).exists()
+    entries = ingest.pending(model_path, files, force)
+    if not entries and existed:
+        print('No new corpus file for', model_path)
+        return
+    print('Counting', len(entries), 'of', len(files), 'corpus files into', model_path)
+    new_files = [entry[0] for entry in entries]
+    connection, pinyin_char_table, record, binary_record, ternary_record, spill = prepare(path, model_path)
+    complete = False
+    try:
+        if settings.corpus_cache and len(new_files) == len(files):
+            # The corpus cache covers every file, so it only helps a full build
+            ids = corpus.annotated('trigram', path, lambda: annotate_data(path, pinyin_char_table, processes),
+                                   *RULES)
+            count_ids(ids, len(pinyin_char_table) + 1, len(pinyin_char_table) + 2,
+                      record, binary_record, ternary_record, spill)
+        elif processes > 1:
+            parallel_count(path, pinyin_char_table, processes, record, binary_record, ternary_record, spill,
+                           new_files)
+        else:
+            for data in read_data(path, new_files):
+                deal_text(data['title'], pinyin_char_table, record, binary_record, ternary_record)
+                deal_text(data['html'], pinyin_char_table, record, binary_record, ternary_record)
+                if spill is not None:
+                    spill.check(ternary_record, 2)
+        complete = True
+    except KeyboardInterrupt:
+        if existed:
+            # Partial counts of the new files can not be recorded in the ledger, so adding them would count
+            # those files twice on the next refresh
+            print('WARNING: interrupted, nothing is added into', model_path)
+            if spill is not None:
+                spill.close()
+            return
+        # Meet keyboard interrupt firstly, just stop reading and keep what is counted
+        print('WARNING: interrupted, the counted files are not recorded as ingested')
+    finish(model_path, connection, record, binary_record, ternary_record, spill, entries if complete else ())
+
+
+def main():
+    parser = ArgumentParser(description='Build a trigram model, or add the new corpus files into it')
+    parser.add_argument('data', help='path/to/data')
+    parser.add_argument('model', help='path/to/trigram.sqlite3')
+    parser.add_argument('--seed', action='store_true',
+                        help='record every corpus file as ingested without counting, for a model built before '
+                             'the ledger which already counts them')
+    parser.add_argument('--force', action='store_true',
+                        help='count every corpus file into a model which has no ledger')
+    args = parser.parse_args()
+    if args.seed:
+        ingest.seed(args.model, corpus.corpus_files(Path(args.data)))
+    else:
+        train(args.data, args.model, force=args.force)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""
+Compile trigram.sqlite3 into a flat binary file which TrigramModel can mmap and query in place
+
+Layout (native little-endian, every section aligned to 8 bytes):
+    header      magic, version, bits, n_chars, text_size, n_bigram, n_trigram_keys, n_trigram
+    char_count  int64[n_chars]              count of char_set in oid order
+    char_text   utf-8[text_size]            "pinyin\\tchar\\n" of char_set in oid order
+    bigram      int64[n_bigram]             sorted packed (left, right)
+                counts[n_bigram]
+    trigram     int64[n_trigram_keys]       sorted packed (left, middle)
+                int64[n_trigram_keys + 1]   offsets into the two arrays below
+                int64[n_trigram]            right (sorted in each bucket)
+                counts[n_trigram]
+counts are int64, or with bits (1, 2, 4 or 8) codes packed bits wide into bytes followed by the
+int64[2 ** bits] codebook of log spaced levels, see codebook().
+Since the file is opened read-only with mmap, every process on one host shares the same physical pages.
+"""
+import sqlite3
+import struct
+import mmap
+import os
+from array import array
+from collections import Counter
+from datetime import datetime
+from math import log
+from pathlib import Path
+from sys import argv, byteorder, stderr
+
+from utils.ngram import PackedBigram, PackedTrigram, Quantized
+
+MAGIC = b'IMTRIGRM'
+VERSION = 2
+HEADER = struct.Struct('<8s7q')
+BITS = (1, 2, 4, 8)
+
+
+def _padding(size: int):
+    return b'\0' * (-size % 8)
+
+
+def codebook(histogram, bits: int):
+    """
+    histogram is [(count, rows)], return ({count: code}, {code: level}) where the level of a code is the
+    mean of the counts it stands for
+    """
+    levels = 1 << bits
+    scale = log(max(count for count, rows in histogram) + 1)
+    code_of = {count: min(levels - 1, int(log(count) / scale * levels)) if count > 0 else 0
+               for count, rows in histogram}
+    total, weight = {}, {}
+    for count, rows in histogram:
+        code = code_of[count]
+        total[code] = total.get(code, 0) + count * rows
+        weight[code] = weight.get(code, 0) + rows
+    return code_of, {code: max(1, round(total[code] / weight[code])) for code in total}
+
+
+def _counts(counts, bits: int):
+    """
+    Return the bytes of the counts section
+    """
+    if not bits:
+        return counts.tobytes()
+    code_of, levels = codebook(Counter(counts).items(), bits) if len(counts) else ({}, {})
+    per = 8 // bits
+    codes = bytearray(-(-len(counts) // per))
+    for index, count in enumerate(counts):
+        codes[index // per] |= code_of[count] << index % per * bits
+    codes += _padding(len(codes))
+    return bytes(codes) + array('q', (levels.get(code, 0) for code in range(1 << bits))).tobytes()
+
+
+def compile_model(model_path='trigram.sqlite3', compiled_path='trigram.bin', bits=0):
+    """
+    bits of 0 keeps the exact counts, or else every count is stored as a code of bits
+    """
+    if bits and bits not in BITS:
+        raise ValueError('bits of quantized counts must be one of %s' % (BITS,))
+    if byteorder != 'little':
+        raise NotImplementedError('Compiled model only supports little-endian machine')
+    now = datetime.now()
+    connection = sqlite3.connect(model_path)
+    char_count = array('q')
+    char_text = []
+    for pinyin, char, count in connection.execute('SELECT pinyin, char, count FROM char_set ORDER BY oid'):
+        char_count.append(count)
+        char_text.append('%s\t%s\n' % (pinyin, char))
+    char_text = ''.join(char_text).encode()
+
+    sql = 'SELECT left, right, count FROM relation2 ORDER BY left, right'
+    bigram = PackedBigram.from_rows(connection.execute(sql), 'qq')
+    sql = 'SELECT left, middle, right, count FROM relation3 ORDER BY left, middle, right'
+    trigram = PackedTrigram.from_rows(connection.execute(sql), 'qqqq')
+    connection.close()
+
+    temp_path = str(compiled_path) + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, bits, len(char_count), len(char_text),
+                               len(bigram), len(trigram), len(trigram.rights)))
+        file.write(char_count.tobytes())
+        file.write(char_text + _padding(len(char_text)))
+        file.write(bigram.keys.tobytes())
+        file.write(_counts(bigram.counts, bits))
+        for each in (trigram.keys, trigram.offsets, trigram.rights):
+            file.write(each.tobytes())
+        file.write(_counts(trigram.counts, bits))
+    os.replace(temp_path, compiled_path)
+    print('Finished compile', model_path, 'into', compiled_path, 'cost',
+          (datetime.now() - now).total_seconds(), 's', file=stderr)
+
+
+def load_compiled(compiled_path='trigram.bin'):
+    """
+    Return (mmap, char_set rows, PackedBigram, PackedTrigram); keep the mmap alive while using the tables
+    """
+    with open(compiled_path, 'rb') as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, bits, n_chars, text_size, n_bigram, n_keys, n_trigram = HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != VERSION:
+        buffer.close()
+        raise ValueError('%s is not a compiled trigram model of version %d' % (compiled_path, VERSION))
+    view = memoryview(buffer)
+    offset = HEADER.size
+
+    def take(length):
+        nonlocal offset
+        section = view[offset:offset + 8 * length].cast('q')
+        offset += 8 * length
+        return section
+
+    def counts(length):
+        nonlocal offset
+        if not bits:
+            return take(length)
+        size = -(-length * bits // 8)
+        codes = view[offset:offset + size]
+        offset += size + len(_padding(size))
+        return Quantized(codes, take(1 << bits), bits, length)
+
+    char_count = take(n_chars)
+    char_text = bytes(view[offset:offset + text_size]).decode()
+    offset += text_size + len(_padding(text_size))
+    rows = [(*line.split('\t'), count) for line, count in zip(char_text.splitlines(), char_count)]
+    relation2 = PackedBigram(take(n_bigram), counts(n_bigram))
+    relation3 = PackedTrigram(take(n_keys), take(n_keys + 1), take(n_trigram), counts(n_trigram))
+    return buffer, rows, relation2, relation3
+
+
+if __name__ == '__main__':
+    if len(argv) not in (3, 4):
+        print('Usage: python -m models.trigram.compile <path/to/trigram.sqlite3> <path/to/trigram.bin> [bits]')
+    else:
+        compile_model(argv[1], Path(argv[2]), int(argv[3]) if len(argv) == 4 else 0)
@@ -0,0 +1,65 @@
+"""
+relation3 fetched bucket by bucket on demand, for short jobs which only decode a few lines
+
+Start-up only loads char_set and relation2, and memory follows the working set instead of the model size.
+The query text never changes, so sqlite3 keeps it prepared in the statement cache of the connection.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from utils.load import connect
+
+_MISSING = object()
+SQL = 'SELECT right, count FROM relation3 WHERE left = ? AND middle = ?'
+
+
+class LazyTrigram:
+    """
+    Read-only mapping (left, middle) -> {right: count}, the least recently used buckets are dropped once
+    there are more than capacity of them; buckets missing in relation3 are cached too
+    """
+
+    def __init__(self, model_path: str, capacity=100000):
+        self.model_path = model_path
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+
+    def _connect(self):
+        # A sqlite connection must not be used across fork, so every process opens its own
+        if self.pid != os.getpid():
+            self.connection = connect(self.model_path, check_same_thread=False)
+            self.pid = os.getpid()
+        return self.connection
+
+    def __len__(self):
+        return len(self.cache)
+
+    def get(self, key, default=None):
+        with self.lock:
+            bucket = self.cache.get(key, _MISSING)
+            if bucket is not _MISSING:
+                self.hits += 1
+                self.cache.move_to_end(key)
+            else:
+                self.misses += 1
+                bucket = dict(self._connect().execute(SQL, key).fetchall()) or None
+                self.cache[key] = bucket
+                if len(self.cache) > self.capacity:
+                    self.cache.popitem(last=False)
+        return default if bucket is None else bucket
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'buckets': len(self.cache),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+        }
@@ -2,12 +2,33 @@ import sqlite3
 from pathlib import Path
 from collections import defaultdict
 from datetime import datetime
+from heapq import nlargest
+from itertools import groupby
+from math import log
+from operator import itemgetter
 from sys import stderr
 
 import settings
+from utils.exception import StrangePinyinError, NoPathError
+from utils.load import Loader
+from utils.ngram import PackedBigram, PackedTrigram
+from ..base import BaseModel
+from .blocks import BlockCache
+from .lazy import LazyTrigram
 
 
-class TrigramModel:
+class State(dict):
+    """
+    Lattice state {(right, mid): {left: score, 0: best score}} after syllable
+    """
+    __slots__ = ('syllable',)
+
+    def __init__(self, syllable=None, *args):
+        super().__init__(*args)
+        self.syllable = syllable
+
+
+class TrigramModel(BaseModel):
     """
     Naive binary model with viterbi algorithm
     """
@@ -17,23 +38,37 @@ class TrigramModel:
             try:
                 from sys import stderr
                 from .build import train
-                print('INFO: try to build model', model_path)
+                print('INFO: try to build model', model_path, file=stderr)
                 train('data', model_path)
             except Exception as e:
                 # Path(model_path).unlink()
-                print(datetime.now(), 'Meet error', type(e), e)
+                print(datetime.now(), 'Meet error', type(e), e, file=stderr)
                 raise e
         self.smooth_1 = settings.smooth_1
         self.smooth_2 = settings.smooth_2
         self.candidates = settings.candidates
+        self.beam = settings.beam
+        self.threshold = settings.threshold
+        self.abbreviated = settings.abbreviated
+        self.abbreviation_beam = settings.abbreviation_beam
+        self.block_cache = BlockCache(settings.block_cache) if settings.block_cache else None
         self.occurrence_bound = settings.occurrence_bound
-        connection = None
-        while connection is None:
+        self.model_path = model_path
+        self.compiled_path = Path(model_path).with_suffix('.bin')
+        self.compiled = None
+        loader = None
+        if settings.use_compiled:
+            if not self.compiled_path.exists() or \
+                    self.compiled_path.stat().st_mtime < Path(model_path).stat().st_mtime:
+                from .compile import compile_model
+                compile_model(model_path, self.compiled_path)
+            loader = False
+        while loader is None:
             try:
-                connection = sqlite3.connect(model_path)
+                loader = Loader(model_path)
             except sqlite3.OperationalError as e:
-                print(datetime.now(), e, 'Keep waiting...')
-        self.connection = connection
+                print(datetime.now(), e, 'Keep waiting...', file=stderr)
+        self.loader = loader
         self.char_pinyin = ()
         self.chars = ()
         self.char_to_count = {}
@@ -42,75 +77,339 @@ class TrigramModel:
         self.relation2 = {}
         self.relation3 = {}
         self.table = defaultdict()
+        self.prefix_table = {}
         self.pinyin_to_index = {}
         self.char_related_count = {}
+        self.load_timing = {}
         self.initialize()
-        self.connection.close()
 
     def _load_charset(self):
-        sql = 'SELECT * from char_set ORDER BY oid'
-        data = self.connection.execute(sql).fetchall()
+        self._set_charset(self.loader.table('char_set', 'SELECT * from char_set ORDER BY oid'))
+
+    def _set_charset(self, data):
         self.chars = ('',) + tuple(each[1] for each in data)
         self.char_to_count = (0,) + tuple(each[2] for each in data)
         total_char_count = sum(self.char_to_count[:-2])
         self.char_to_likelihood = [count / total_char_count for count in self.char_to_count]
         for index, (pinyin, char, count) in enumerate(data):
             self.table.setdefault(pinyin, []).append(index + 1)
+        if settings.cap_candidates:
+            for pinyin, candidates in self.table.items():
+                candidates.sort(key=lambda x: self.char_to_count[x], reverse=True)
+                del candidates[self.candidates:]
+        if self.abbreviated:
+            self._set_prefix_table()
+
+    def _set_prefix_table(self):
+        """
+        Candidates of every prefix which is not a syllable itself, such as "zh" for "zhong" and "zhang",
+        the most frequent chars of all the syllables it starts, at most abbreviation_candidates of them
+        """
+        prefixes = defaultdict(set)
+        for pinyin, candidates in self.table.items():
+            for end in range(1, len(pinyin)):
+                if pinyin[:end] not in self.table:
+                    prefixes[pinyin[:end]].update(candidates)
+        self.prefix_table = {prefix: sorted(candidates, key=lambda x: (-self.char_to_count[x], x))
+                             [:settings.abbreviation_candidates] for prefix, candidates in prefixes.items()}
 
     def _load_relation(self):
-        sql = 'SELECT left, group_concat(right), group_concat(count) FROM relation2 GROUP BY left'
-        self.relation2 = {(left, right): count for left, rights, counts in self.connection.execute(sql) for
-                          right, count in zip(map(int, rights.split(',')), map(int, counts.split(',')))}
+        sql = 'SELECT left, right, count FROM relation2 ORDER BY left, right'
+        if settings.use_compact:
+            self.relation2 = self.loader.table('relation2', sql, PackedBigram.from_rows)
+        else:
+            self.relation2 = self.loader.table('relation2', sql, lambda rows: {(left, right): count for
+                                                                               left, right, count in rows})
 
         # total_relation_count = sum(self.relation2.values())
         # self.relation_to_likelihood = {key: count / total_relation_count for key, count in self.relation2.items()}
 
-        sql = 'SELECT left, middle, group_concat(right), group_concat(count) FROM relation3 GROUP BY left, middle'
-        self.relation3 = {(left, mid): dict(zip(map(int, rights.split(',')), map(int, counts.split(','))))
-                          for left, mid, rights, counts in self.connection.execute(sql)}
+        if settings.lazy_relation3:
+            self.relation3 = LazyTrigram(self.model_path, settings.lazy_cache)
+            return
+        sql = 'SELECT left, middle, right, count FROM relation3 ORDER BY left, middle, right'
+        if settings.use_compact:
+            self.relation3 = self.loader.table('relation3', sql, PackedTrigram.from_rows)
+        else:
+            self.relation3 = self.loader.table('relation3', sql, self._trigram_dict)
+
+    @staticmethod
+    def _trigram_dict(rows):
+        result = {}
+        for (left, middle), group in groupby(rows, key=itemgetter(0, 1)):
+            result[left, middle] = {right: count for _, _, right, count in group}
+        return result
+
+    def _load_compiled(self):
+        from .compile import load_compiled, compile_model
+        try:
+            self.compiled, data, self.relation2, self.relation3 = load_compiled(self.compiled_path)
+        except ValueError as e:
+            # Written by an older version
+            print(e, 'compile it again', file=stderr)
+            compile_model(self.model_path, self.compiled_path)
+            self.compiled, data, self.relation2, self.relation3 = load_compiled(self.compiled_path)
+        self._set_charset(data)
 
     def initialize(self):
-        print('Loading model, it may cost 20 second...', file=stderr)
         now = datetime.now()
-        self._load_charset()
-        self._load_relation()
-        print('Finished load model, cost ', (datetime.now() - now).total_seconds(), 's', file=stderr)
+        if self.loader:
+            print('Loading model, it may cost 20 second...', file=stderr)
+            self._load_charset()
+            self._load_relation()
+            self.loader.close()
+            self.load_timing = self.loader.timing
+        else:
+            print('Loading compiled model', self.compiled_path, file=stderr)
+            self._load_compiled()
+        print('Finished load model, cost ', (datetime.now() - now).total_seconds(), 's',
+              self.loader and '(%s)' % self.loader.report() or '', file=stderr)
 
-    def _get_next_state(self, last_state, candidates):
+    def _get_next_state(self, last_state, candidates, syllable=None):
+        """
+        Scores are log probabilities, so long inputs do not underflow to 0
+        """
+        previous = getattr(last_state, 'syllable', None)
+        if self.block_cache is not None and syllable is not None and previous is not None:
+            return self._prune(self._get_cached_state(last_state, candidates, syllable, previous))
         smooth_1 = self.smooth_1
         smooth_2 = self.smooth_2
-        state = defaultdict(dict)
-        for right in candidates:
-            p1 = self.char_to_likelihood[right]
-            for mid, left in last_state:
-                p2 = self.relation2.get((mid, right), 0) / (self.char_to_count[mid] or 1)
-                p_last = last_state[mid, left][0]
-                count_left_mid = self.relation2.get((left, mid), 0)
-                count_left_mid_right = self.relation3.get((left, mid), {}).get(right, 0)
-                p3 = count_left_mid and count_left_mid_right / count_left_mid
-                p = p_last * (smooth_1 * p1 + smooth_2 * p2 + (1 - smooth_1 - smooth_2) * p3)
+        smooth_3 = 1 - smooth_1 - smooth_2
+        char_to_likelihood = self.char_to_likelihood
+        relation2 = self.relation2
+        state = State(syllable)
+        for (mid, left), transition in last_state.items():
+            p_last = transition[0]
+            count_mid = self.char_to_count[mid] or 1
+            count_left_mid = relation2.get((left, mid), 0)
+            relation3 = self.relation3.get((left, mid), {})
+            for right in candidates:
+                p1 = char_to_likelihood[right]
+                p2 = relation2.get((mid, right), 0) / count_mid
+                p3 = count_left_mid and relation3.get(right, 0) / count_left_mid
+                p = smooth_1 * p1 + smooth_2 * p2 + smooth_3 * p3
                 if p == 0:
                     continue
-                state[right, mid][left] = p
-                state[right, mid][0] = max(state[right, mid].get(0, 0), p)
+                p = p_last + log(p)
+                current = state.get((right, mid))
+                if current is None:
+                    state[right, mid] = {left: p, 0: p}
+                else:
+                    current[left] = p
+                    current[0] = max(current[0], p)
+        return self._prune(state)
+
+    def _block_row(self, mid, candidates):
+        """
+        (right, base, log(base) or None if base is 0) for every right, base is the sum of the unigram and
+        bigram components, which only depends on mid
+        """
+        smooth_1 = self.smooth_1
+        smooth_2 = self.smooth_2
+        relation2 = self.relation2
+        count_mid = self.char_to_count[mid] or 1
+        row = []
+        for right in candidates:
+            base = smooth_1 * self.char_to_likelihood[right] + smooth_2 * (relation2.get((mid, right), 0) / count_mid)
+            row.append((right, base, log(base) if base else None))
+        return tuple(row)
+
+    def _get_cached_state(self, last_state, candidates, syllable, previous):
+        """
+        _get_next_state with the block of (previous, syllable), the same sums in the same order,
+        so the scores are exactly the same
+        """
+        smooth_3 = 1 - self.smooth_1 - self.smooth_2
+        relation2 = self.relation2
+        block = self.block_cache.get((previous, syllable))
+        state = State(syllable)
+        for (mid, left), transition in last_state.items():
+            p_last = transition[0]
+            row = block.get(mid)
+            if row is None:
+                row = block[mid] = self._block_row(mid, candidates)
+            count_left_mid = relation2.get((left, mid), 0)
+            relation3 = count_left_mid and self.relation3.get((left, mid))
+            for right, base, log_base in row:
+                count = relation3 and relation3.get(right)
+                if count:
+                    p = p_last + log(base + smooth_3 * (count / count_left_mid))
+                elif log_base is None:
+                    continue
+                else:
+                    p = p_last + log_base
+                current = state.get((right, mid))
+                if current is None:
+                    state[right, mid] = {left: p, 0: p}
+                else:
+                    current[left] = p
+                    current[0] = max(current[0], p)
         return state
 
-    def predict(self, pinyin: str):
-        stop = len(self.chars) - 1  # for $
-        start = stop - 1  # for ^
-        states = [{(start, start): {0: 1}}]
-        for each in pinyin.split():
-            each = each.lower()
-            candidates = self.table.get(each)
-            if not candidates:
-                raise StrangePinyinError(each)
-            states.append(self._get_next_state(states[-1], candidates))
-        states.append(self._get_next_state(states[-1], [stop]))
-        states.append(self._get_next_state(states[-1], [stop]))
-        result = [stop, stop]
+    def block_stats(self):
+        return self.block_cache.stats() if self.block_cache is not None else None
+
+    def _lattice_step(self, last_scores, syllable, candidates):
+        """
+        Same sums as _get_next_state, keeping only the best (score, prev_key) of every key,
+        the mids of a lattice position follow different syllables, so they share the block (None, syllable)
+        """
+        smooth_3 = 1 - self.smooth_1 - self.smooth_2
+        relation2 = self.relation2
+        block = {} if self.block_cache is None or syllable is None else self.block_cache.get((None, syllable))
+        state = {}
+        for (mid, left), p_last in last_scores.items():
+            row = block.get(mid)
+            if row is None:
+                row = block[mid] = self._block_row(mid, candidates)
+            count_left_mid = relation2.get((left, mid), 0)
+            relation3 = count_left_mid and self.relation3.get((left, mid))
+            for right, base, log_base in row:
+                count = relation3 and relation3.get(right)
+                if count:
+                    p = p_last + log(base + smooth_3 * (count / count_left_mid))
+                elif log_base is None:
+                    continue
+                else:
+                    p = p_last + log_base
+                best = state.get((right, mid))
+                if best is None or p > best[0]:
+                    state[right, mid] = p, (mid, left)
+        if self.observer is not None:
+            self._created = len(state)
+        if syllable is not None and syllable not in self.table and len(state) > self.abbreviation_beam:
+            kept = nlargest(self.abbreviation_beam, state, key=lambda x: state[x][0])
+            state = {key: state[key] for key in kept}
+        return state
+
+    def _kbest_edges(self, prev_keys, syllable, candidates):
+        """
+        Same sums as _lattice_step, sharing its blocks
+        """
+        smooth_3 = 1 - self.smooth_1 - self.smooth_2
+        relation2 = self.relation2
+        block = {} if self.block_cache is None or syllable is None else self.block_cache.get((None, syllable))
+        for mid, left in prev_keys:
+            row = block.get(mid)
+            if row is None:
+                row = block[mid] = self._block_row(mid, candidates)
+            count_left_mid = relation2.get((left, mid), 0)
+            relation3 = count_left_mid and self.relation3.get((left, mid))
+            for right, base, log_base in row:
+                count = relation3 and relation3.get(right)
+                if count:
+                    yield (right, mid), (mid, left), log(base + smooth_3 * (count / count_left_mid))
+                elif log_base is not None:
+                    yield (right, mid), (mid, left), log_base
+
+    def _kbest_keep(self, scores, syllable):
+        """
+        The keys kept by _prune, and by the abbreviation beam after a prefix
+        """
+        keys = list(scores)
+        if self.threshold and keys:
+            bound = max(scores.values()) - self.threshold
+            keys = [key for key in keys if scores[key] >= bound]
+        if self.beam and len(keys) > self.beam:
+            keys = nlargest(self.beam, keys, key=scores.get)
+        if syllable is not None and syllable not in self.table and len(keys) > self.abbreviation_beam:
+            keys = nlargest(self.abbreviation_beam, keys, key=scores.get)
+        return keys
+
+    def _prune(self, state):
+        """
+        Drop states scoring below best - threshold, then keep the best beam ones
+        """
+        if self.observer is not None:
+            self._created = len(state)
+        if self.threshold and state:
+            bound = max(transition[0] for transition in state.values()) - self.threshold
+            state = State(state.syllable, ((key, transition) for key, transition in state.items()
+                                           if transition[0] >= bound))
+        if self.beam and len(state) > self.beam:
+            kept = set(nlargest(self.beam, state, key=lambda x: state[x][0]))
+            state = State(state.syllable, ((key, transition) for key, transition in state.items() if key in kept))
+        return state
+
+    def _start_state(self):
+        start = len(self.chars) - 2  # for ^
+        return State('', {(start, start): {0: 0}})
+
+    def _candidates(self, syllable):
+        candidates = self.table.get(syllable) or self.prefix_table.get(syllable)
+        if not candidates:
+            raise StrangePinyinError(syllable)
+        return candidates
+
+    def _next_state(self, last_state, syllable):
+        state = self._get_next_state(last_state, self._candidates(syllable), syllable)
+        if not state:
+            raise NoPathError(syllable)
+        if syllable not in self.table and len(state) > self.abbreviation_beam:
+            # The states after a prefix are many, keep the best ones as the next step multiplies them
+            kept = set(nlargest(self.abbreviation_beam, state, key=lambda x: state[x][0]))
+            state = State(syllable, ((key, transition) for key, transition in state.items() if key in kept))
+        return state
+
+    def _finish(self, states):
+        start, stop = len(self.chars) - 2, len(self.chars) - 1  # for ^ and $
+        states = list(states)
+        for _ in range(2):
+            state = self._get_next_state(states[-1], [stop])
+            if not state:
+                # The model has not seen the sentence end, so it tells nothing, as in _decode_lattice
+                break
+            states.append(state)
+        last = states[-1]
+        result = list(max(last, key=lambda x: last[x][0]))
         for state in states[:1:-1]:
             right, mid = result[-2:]
             transition = state[right, mid]
-            transition.pop(0)
-            result.append(max(transition, key=lambda x: transition[x]))
-        return ''.join(map(lambda x: self.chars[x], reversed(result[2:-1])))
+            result.append(max(filter(lambda x: x, transition), key=lambda x: transition[x]))
+        # Without syllables the best path is only ^ and $
+        return ''.join(self.chars[x] for x in reversed(result[:-1]) if x not in (start, stop))
+
+    def _start_key(self):
+        start = len(self.chars) - 2  # for ^
+        return start, start
+
+    def _stop_steps(self):
+        stop = len(self.chars) - 1  # for $
+        return [[stop], [stop]]
+
+    def _key_char(self, key):
+        return key[0]
+
+    def _weights(self):
+        return self.smooth_1, self.smooth_2, 1 - self.smooth_1 - self.smooth_2
+
+    def _edges(self, prev_keys, candidates):
+        for mid, left in prev_keys:
+            count_mid = self.char_to_count[mid] or 1
+            count_left_mid = self.relation2.get((left, mid), 0)
+            relation3 = self.relation3.get((left, mid), {})
+            for right in candidates:
+                p1 = self.char_to_likelihood[right]
+                p2 = self.relation2.get((mid, right), 0) / count_mid
+                p3 = count_left_mid and relation3.get(right, 0) / count_left_mid
+                yield (right, mid), (mid, left), (p1, p2, p3)
+
+    def _tables(self):
+        return (self, 'relation2'), (self, 'relation3')
+
+    def _step_stats(self, last_state, state, candidates):
+        return self._created, len(state)
+
+    def _lattice_stats(self, state):
+        return self._created, len(state)
+
+    def _cache_stats(self):
+        result = {}
+        if self.block_cache is not None:
+            result['block_hits'] = self.block_cache.hits
+            result['block_misses'] = self.block_cache.misses
+        relation3 = getattr(self.relation3, 'table', self.relation3)
+        if isinstance(relation3, LazyTrigram):
+            # Every miss is a query of the database
+            result['lazy_misses'] = relation3.misses
+        return result
@@ -0,0 +1,151 @@
+"""
+Performance benchmark suite, writes machine readable JSON so that versions can be compared
+
+For every model class, in a fresh process: load time, peak RSS, per-sentence decode latency
+(p50/p95/p99 bucketed by syllable count) and throughput in lines per second.
+For every build, documents per second on a synthetic corpus generated from data/table.txt.
+Usage: python perf.py [--input input/in3.txt] [--output perf.json] [--models trigram pinyin naive] [--docs 500]
+"""
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+import models
+import settings
+
+BUCKETS = ((1, 4), (5, 8), (9, 16), (17, 32), (33, None))
+
+
+def percentile(values, rate):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(rate * len(values)))] if values else None
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_model(name: str, inputs: list):
+    from utils.exception import StrangePinyinError
+    model_class = models.model_class(name)
+    now = perf_counter()
+    model = model_class()
+    result = {'load_s': perf_counter() - now, 'load_peak_rss_mb': peak_rss_mb(),
+              'load_phases_s': getattr(model, 'load_timing', {})}
+    latency = {bucket: [] for bucket in BUCKETS}
+    failed = 0
+    # Bucket by the segmented syllables, as unspaced pinyin like "nihao" has no spaces to count,
+    # and segment before timing so that lines_per_s only counts decoding
+    lengths = []
+    for line in inputs:
+        try:
+            lengths.append(len(model._syllables(line)))
+        except StrangePinyinError:
+            lengths.append(0)
+    now = perf_counter()
+    for line, length in zip(inputs, lengths):
+        start = perf_counter()
+        try:
+            model.predict(line)
+        except StrangePinyinError:
+            failed += 1
+            continue
+        cost = perf_counter() - start
+        for low, high in BUCKETS:
+            if length >= low and (high is None or length <= high):
+                latency[low, high].append(cost * 1000)
+    total = perf_counter() - now
+    result['decode'] = {
+        '%d-%s' % (low, high or ''): {
+            'count': len(latency[low, high]),
+            'p50_ms': percentile(latency[low, high], 0.5),
+            'p95_ms': percentile(latency[low, high], 0.95),
+            'p99_ms': percentile(latency[low, high], 0.99),
+        } for low, high in BUCKETS
+    }
+    result['lines'] = len(inputs)
+    result['failed'] = failed
+    result['lines_per_s'] = len(inputs) / total if total else None
+    result['peak_rss_mb'] = peak_rss_mb()
+    if hasattr(model, 'block_stats'):
+        result['block_cache'] = model.block_stats()
+    return result
+
+
+def make_corpus(path: Path, docs: int, seed=0):
+    """
+    Write table.txt, charset.txt and a corpus file of random sentences over the chars of data/table.txt
+    """
+    random.seed(seed)
+    shutil.copy('data/table.txt', str(path.joinpath('table.txt')))
+    lines = open('data/table.txt', encoding='gbk')
+    chars = list(dict.fromkeys(char for line in lines for char in line.split()[1:]))
+    open(str(path.joinpath('charset.txt')), 'w', encoding='gbk').write(''.join(chars))
+    common = chars[:500]
+
+    def sentence():
+        return ''.join(random.choice(common) for _ in range(random.randint(4, 20)))
+
+    with open(str(path.joinpath('%s-synthetic.txt' % settings.key)), 'w', encoding='gbk') as file:
+        for _ in range(docs):
+            html = '，'.join(sentence() for _ in range(random.randint(3, 12))) + '。'
+            file.write(json.dumps({'title': sentence(), 'html': html}, ensure_ascii=False) + '\n')
+
+
+def bench_build(name: str, docs: int):
+    build = models.build_module(name)
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory)
+        make_corpus(path, docs)
+        now = perf_counter()
+        build.train(str(path), str(path.joinpath(name + '.sqlite3')))
+        cost = perf_counter() - now
+    return {'docs': docs, 'seconds': cost, 'docs_per_s': docs / cost}
+
+
+def run_isolated(function, *args):
+    """
+    Run in a fresh interpreter, so load time and peak RSS are not polluted by other models
+    """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark load, decode and build performance')
+    parser.add_argument('--input', default=settings.input_file, help='pinyin file to decode')
+    parser.add_argument('--output', default='perf.json')
+    parser.add_argument('--models', nargs='+', choices=models.MODELS, default=list(models.MODELS))
+    parser.add_argument('--docs', type=int, default=500, help='documents of the synthetic build corpus')
+    parser.add_argument('--skip-build', action='store_true')
+    args = parser.parse_args()
+    inputs = [line.strip() for line in open(args.input) if line.strip()]
+    report = {
+        'time': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'input': args.input,
+        'models': {},
+        'build': {},
+    }
+    for name in args.models:
+        report['models'][name] = run_isolated(bench_model, name, inputs)
+        print(name, json.dumps(report['models'][name]))
+        if not args.skip_build:
+            report['build'][name] = run_isolated(bench_build, name, args.docs)
+            print(name, 'build', json.dumps(report['build'][name]))
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Shrink a built model database for memory constrained hosts, and report what every setting costs
+
+Pruning drops rows of the highest order table (relation, or relation3 of TrigramModel):
+    count       drop n-grams seen at most threshold times
+    entropy     drop n-grams whose weighted log ratio p(w|h) * log(p(w|h) / p'(w|h)) is below threshold,
+                where p' is the smoothed probability once the n-gram is gone (Stolcke style)
+History counts are kept as they are, so the probabilities of the remaining n-grams do not change.
+Quantization is only for TrigramModel, it compiles the database into the mmap format of models.trigram.compile
+with every count stored as a code of a few bits and a codebook of log spaced levels, SQLite has no column
+narrower than a byte.
+For every setting the report has the size of the file the model reads, rows, load time, decode speed and
+accuracy.
+Usage: python prune.py --model trigram [--source trigram.sqlite3] [--count 5 10] [--entropy 1e-7] [--bits 0 8 4]
+"""
+import json
+import sqlite3
+from argparse import ArgumentParser
+from math import log, inf
+from pathlib import Path
+from time import perf_counter
+
+import models
+import settings
+from perf import run_isolated
+from models.trigram.compile import BITS, compile_model
+from utils.ngram import PackedBigram
+
+TABLES = {
+    'naive': ('charset', ['relation']),
+    'pinyin': ('char_set', ['relation']),
+    'trigram': ('char_set', ['relation2', 'relation3']),
+}
+
+
+def _unigram(connection: sqlite3.Connection, name: str):
+    counts = (0,) + tuple(count for count, in connection.execute(f'SELECT count FROM {TABLES[name][0]} ORDER BY oid'))
+    total = sum(counts[:-2])
+    return counts, [count / total for count in counts]
+
+
+def _entropy_scores(connection: sqlite3.Connection, name: str):
+    """
+    Yield (rowid, score) for every row of the highest order table
+    """
+    counts, unigram = _unigram(connection, name)
+    if name == 'trigram':
+        smooth_1, smooth_2 = settings.smooth_1, settings.smooth_2
+        smooth_3 = 1 - smooth_1 - smooth_2
+        sql = 'SELECT left, right, count FROM relation2 ORDER BY left, right'
+        bigram = PackedBigram.from_rows(connection.execute(sql))
+        total = connection.execute('SELECT sum(count) FROM relation3').fetchone()[0] or 1
+        sql = 'SELECT oid, left, middle, right, count FROM relation3'
+        for rowid, left, middle, right, count in connection.execute(sql):
+            history = bigram.get((left, middle), 0)
+            rest = smooth_1 * unigram[right] + smooth_2 * bigram.get((middle, right), 0) / (counts[middle] or 1)
+            full = rest + (history and smooth_3 * count / history)
+            yield rowid, count / total * log(full / rest) if rest else inf
+    else:
+        smooth = settings.smooth
+        total = connection.execute('SELECT sum(count) FROM relation').fetchone()[0] or 1
+        for rowid, left, right, count in connection.execute('SELECT oid, left, right, count FROM relation'):
+            rest = (1 - smooth) * unigram[right]
+            full = rest + (counts[left] and smooth * count / counts[left])
+            yield rowid, count / total * log(full / rest) if rest else inf
+
+
+def prune(connection: sqlite3.Connection, name: str, method: str, threshold: float):
+    table = TABLES[name][1][-1]
+    with connection:
+        if method == 'count':
+            connection.execute(f'DELETE FROM {table} WHERE count <= ?', (threshold,))
+        else:
+            dropped = [(rowid,) for rowid, score in _entropy_scores(connection, name) if score < threshold]
+            connection.executemany(f'DELETE FROM {table} WHERE oid = ?', dropped)
+
+
+def shrink(name: str, source: str, target: str, method=None, threshold=0, bits=0):
+    """
+    Write a pruned copy of source into target, and with bits compile it into target.bin,
+    return rows left in every relation table
+    """
+    Path(target).unlink(missing_ok=True)
+    connection = sqlite3.connect(target)
+    with sqlite3.connect(source) as origin:
+        origin.backup(connection)
+    if method:
+        prune(connection, name, method, threshold)
+    rows = {table: connection.execute(f'SELECT count(*) FROM {table}').fetchone()[0] for table in TABLES[name][1]}
+    connection.execute('VACUUM')
+    connection.close()
+    if bits:
+        compile_model(target, Path(target).with_suffix('.bin'), bits)
+    return rows
+
+
+def evaluate(name: str, path: str, inputs: list, answers: list, compiled=False):
+    from tuning import accuracy
+    # Runs in a fresh interpreter, so this only affects the model evaluated here
+    settings.use_compiled = compiled
+    model_class = models.model_class(name)
+    now = perf_counter()
+    model = model_class(path)
+    load = perf_counter() - now
+    now = perf_counter()
+    results = model.predict_many(inputs, default='')
+    cost = perf_counter() - now
+    char_accuracy, line_accuracy = accuracy(results, answers)
+    return {'load_s': load, 'lines_per_s': len(inputs) / cost if cost else None,
+            'char_accuracy': char_accuracy, 'line_accuracy': line_accuracy}
+
+
+def main():
+    parser = ArgumentParser(description='Prune and quantize a model database, report size, speed and accuracy')
+    parser.add_argument('--model', choices=models.MODELS, default='trigram')
+    parser.add_argument('--source', help='model database, default <model>.sqlite3 of the model class')
+    parser.add_argument('--output-dir', default='pruned')
+    parser.add_argument('--count', type=float, nargs='*', default=[], help='count thresholds')
+    parser.add_argument('--entropy', type=float, nargs='*', default=[], help='entropy thresholds')
+    parser.add_argument('--bits', type=int, nargs='*', default=[0], choices=(0,) + BITS,
+                        help='bits of quantized counts in a compiled TrigramModel, 0 keeps them')
+    parser.add_argument('--input', default=settings.input_file)
+    parser.add_argument('--answer', default=settings.answer_file)
+    parser.add_argument('--report', default='prune.json')
+    args = parser.parse_args()
+    if any(args.bits) and args.model != 'trigram':
+        parser.error('only the compiled TrigramModel supports quantized counts')
+    source = args.source or args.model + '.sqlite3'
+    inputs = [line.strip() for line in open(args.input) if line.strip()]
+    answers = [line.strip() for line in open(args.answer) if line.strip()]
+    Path(args.output_dir).mkdir(exist_ok=True)
+    settings_list = [(None, 0)] + [('count', each) for each in args.count] + \
+                    [('entropy', each) for each in args.entropy]
+    with sqlite3.connect(source) as connection:
+        rows = {table: connection.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+                for table in TABLES[args.model][1]}
+    report = [{'method': 'source', 'path': source, 'rows': rows, 'size_mb': Path(source).stat().st_size / 2 ** 20,
+               **run_isolated(evaluate, args.model, source, inputs, answers)}]
+    print(json.dumps(report[-1]))
+    for method, threshold in settings_list:
+        for bits in args.bits:
+            if not method and not bits:
+                continue
+            target = str(Path(args.output_dir).joinpath('%s-%s%g-q%d.sqlite3' % (
+                args.model, method or 'none', threshold, bits)))
+            now = perf_counter()
+            rows = shrink(args.model, source, target, method, threshold, bits)
+            path = Path(target).with_suffix('.bin') if bits else Path(target)
+            report.append({'method': method, 'threshold': threshold, 'bits': bits, 'path': str(path),
+                           'shrink_s': perf_counter() - now, 'rows': rows,
+                           'size_mb': path.stat().st_size / 2 ** 20,
+                           **run_isolated(evaluate, args.model, target, inputs, answers, bool(bits))})
+            print(json.dumps(report[-1]))
+    with open(args.report, 'w') as file:
+        json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Conversion server, load the model once and serve predict requests on a local socket
+
+Protocol, one request per line and one response line per request, in order:
+    ni hao                                  -> 你好 (an empty line if the pinyin can not be converted)
+    {"id": 1, "pinyin": "ni hao"}           -> {"id": 1, "result": "你好", "latency_ms": 0.8}
+    STATS                                   -> {"pending": 0, "served": 10, "latency_ms": {...}}
+Usage: python server.py [--model trigram] [--port 8765 | --unix path/to/socket] [--workers 4] [--processes]
+"""
+import asyncio
+import json
+import multiprocessing
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from sys import stderr
+from time import perf_counter
+
+import models
+from utils.exception import StrangePinyinError
+
+# Loaded once in the main process, threads share it and forked worker processes inherit it
+_model = None
+
+
+def _predict(pinyin: str):
+    try:
+        return _model.predict(pinyin), None
+    except StrangePinyinError as e:
+        return None, e.args[0]
+
+
+def percentile(values, rate):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(rate * len(values)))] if values else 0
+
+
+class Server:
+    def __init__(self, executor, window=1000):
+        self.executor = executor
+        self.pending = 0
+        self.served = 0
+        self.latency = deque(maxlen=window)
+
+    def stats(self):
+        latency = [each * 1000 for each in self.latency]
+        return {
+            'pending': self.pending,
+            'served': self.served,
+            'latency_ms': {
+                'mean': sum(latency) / len(latency) if latency else 0,
+                'p50': percentile(latency, 0.5),
+                'p95': percentile(latency, 0.95),
+                'p99': percentile(latency, 0.99),
+            },
+        }
+
+    async def convert(self, pinyin: str):
+        now = perf_counter()
+        self.pending += 1
+        try:
+            result, error = await asyncio.get_running_loop().run_in_executor(self.executor, _predict, pinyin)
+        finally:
+            self.pending -= 1
+        latency = perf_counter() - now
+        self.served += 1
+        self.latency.append(latency)
+        return result, error, latency
+
+    async def respond(self, line: str):
+        if line == 'STATS':
+            return json.dumps(self.stats())
+        if not line.startswith('{'):
+            result, error, latency = await self.convert(line)
+            return result or ''
+        try:
+            request = json.loads(line)
+            pinyin = request['pinyin']
+        except (ValueError, KeyError, TypeError) as e:
+            return json.dumps({'error': 'bad request: %s' % e})
+        if not isinstance(pinyin, str):
+            return json.dumps({'id': request.get('id'), 'error': 'bad request: pinyin must be a string'})
+        result, error, latency = await self.convert(pinyin)
+        response = {'id': request.get('id'), 'result': result, 'latency_ms': latency * 1000}
+        if error is not None:
+            response['error'] = 'strange pinyin: %s' % error
+        return json.dumps(response, ensure_ascii=False)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode(errors='replace').strip()
+                try:
+                    response = await self.respond(line)
+                except Exception as e:
+                    # One bad request must not close the connection of the client
+                    print('Failed to serve', repr(line), type(e).__name__, e, file=stderr)
+                    response = json.dumps({'error': 'internal error: %s' % e}) if line.startswith('{') else ''
+                writer.write((response + '\n').encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(server: Server, host='127.0.0.1', port=8765, unix=None):
+    if unix:
+        listener = await asyncio.start_unix_server(server.handle, unix)
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+    print('Serving on', unix or '%s:%d' % (host, port), file=stderr)
+    async with listener:
+        await listener.serve_forever()
+
+
+def main():
+    global _model
+    parser = ArgumentParser(description='Pinyin conversion server')
+    parser.add_argument('--model', choices=models.MODELS, default='trigram')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help='listen on this unix socket instead of tcp')
+    parser.add_argument('--workers', type=int, default=4, help='size of the decoding pool')
+    parser.add_argument('--processes', action='store_true', help='decode in worker processes instead of threads')
+    args = parser.parse_args()
+    _model = models.model_class(args.model)()
+    if args.processes:
+        executor = ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context('fork'))
+    else:
+        executor = ThreadPoolExecutor(args.workers)
+    with executor:
+        try:
+            asyncio.run(serve(Server(executor), args.host, args.port, args.unix))
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -5,9 +5,26 @@ smooth_1 = float(os.environ.get('INPUT_METHOD_SMOOTH_1', 0.1))
 smooth_2 = float(os.environ.get('INPUT_METHOD_SMOOTH_2', 0.2))
 input_file = os.environ.get('FILE_IN', 'input/in3.txt')
 answer_file = os.environ.get('FILE_ANS', 'output/ans3.txt')
-use_binary = os.environ.get('USE_BINARY_MODEL', False)
+use_binary = os.environ.get('USE_BINARY_MODEL', '0') != '0'
+use_compiled = os.environ.get('USE_COMPILED_MODEL', '0') != '0'
+use_compact = os.environ.get('USE_COMPACT_MODEL', '0') != '0'
+lazy_relation3 = os.environ.get('INPUT_METHOD_LAZY', '0') != '0'
+lazy_cache = int(os.environ.get('INPUT_METHOD_LAZY_CACHE', 100000))
+load_in_memory = os.environ.get('INPUT_METHOD_IN_MEMORY', '0') != '0'
+abbreviated = os.environ.get('INPUT_METHOD_ABBREVIATED', '0') != '0'
+abbreviation_candidates = int(os.environ.get('INPUT_METHOD_ABBREVIATION_CANDIDATES', 20))
+abbreviation_beam = int(os.environ.get('INPUT_METHOD_ABBREVIATION_BEAM', 100))
+block_cache = int(os.environ.get('INPUT_METHOD_BLOCK_CACHE', 1024))
+viterbi_rows = int(os.environ.get('INPUT_METHOD_VITERBI_ROWS', 100000))
+use_numpy = os.environ.get('USE_NUMPY', '1') != '0'
 candidates = 20
+cap_candidates = os.environ.get('INPUT_METHOD_CAP_CANDIDATES', '0') != '0'
+beam = int(os.environ.get('INPUT_METHOD_BEAM', 0))
+threshold = float(os.environ.get('INPUT_METHOD_THRESHOLD', 0))
 occurrence_bound = 5
 key = os.environ.get('FILE_KEY', '2016')
+corpus_cache = os.environ.get('CORPUS_CACHE', '1') != '0'
+build_memory = int(os.environ.get('BUILD_MEMORY_MB', 0))
+processes = int(os.environ.get('BUILD_PROCESSES', 1))
 warning = False
 debug = False
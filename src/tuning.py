@@ -0,0 +1,154 @@
+"""
+Smoothing parameter grid search in one process
+
+The model is loaded once and the transition components of every test sentence are cached as a lattice,
+so scoring another set of smoothing weights is pure arithmetic without any dictionary lookup.
+Within the edges into one lattice key, components which do not change with the previous key are factored
+out, so most edges collapse into "best previous score + log(weights . components)", and only the edges
+with a non-zero n-gram count are scored one by one.
+"""
+import multiprocessing
+from math import log, inf
+from operator import mul
+from sys import stderr
+
+from utils.exception import StrangePinyinError
+
+
+def _dot(weights, components):
+    return sum(map(mul, weights, components))
+
+
+class Lattice:
+    """
+    Cached lattice of one sentence, step t holds for every key (base components, group id, sparse edges)
+    where the key can follow every previous key in groups[t][group id], and the sparse edges
+    (previous index, extra components) add components which depend on the previous key
+    """
+
+    def __init__(self, model, pinyin: str):
+        syllables = model._syllables(pinyin)
+        steps = [model._candidates(each) for each in syllables] + model._stop_steps()
+        self.length = len(syllables)
+        keys = [model._start_key()]
+        self.chars = []
+        self.steps = []
+        self.groups = []
+        for candidates in steps:
+            position = {key: index for index, key in enumerate(keys)}
+            edges = {}
+            for key, prev_key, components in model._edges(keys, candidates):
+                if not any(components):
+                    continue
+                each = edges.get(key)
+                if each is None:
+                    each = edges[key] = [], []
+                each[0].append(position[prev_key])
+                each[1].append(components)
+            groups = {}
+            step = []
+            for prevs, components in edges.values():
+                columns = list(zip(*components))
+                varying = [column.count(column[0]) != len(column) for column in columns]
+                base = tuple(0 if vary else column[0] for vary, column in zip(varying, columns))
+                nonzero = sorted({index for vary, column in zip(varying, columns) if vary
+                                  for index, component in enumerate(column) if component})
+                sparse = [(prevs[index], tuple(c if vary else 0 for vary, c in zip(varying, components[index])))
+                          for index in nonzero]
+                step.append((base, groups.setdefault(tuple(prevs), len(groups)), sparse))
+            self.steps.append(step)
+            self.groups.append(list(groups))
+            keys = list(edges)
+            self.chars.append([model.chars[model._key_char(key)] for key in keys])
+
+    def decode(self, weights):
+        scores = [0.0]
+        backs = []
+        ended = False
+        for index, (step, groups) in enumerate(zip(self.steps, self.groups)):
+            if ended:
+                backs.append(list(range(len(scores))))
+                continue
+            best_of_group = []
+            for group in groups:
+                prev = max(group, key=scores.__getitem__)
+                best_of_group.append((scores[prev], prev))
+            new_scores, back = [], []
+            for base, group, sparse in step:
+                p = _dot(weights, base)
+                score, prev = best_of_group[group]
+                score = score + log(p) if p > 0 else -inf
+                for prev_index, extra in sparse:
+                    q = p + _dot(weights, extra)
+                    if q <= 0:
+                        # A component with weight 0, the edge does not exist under these weights
+                        continue
+                    candidate = scores[prev_index] + log(q)
+                    if candidate > score:
+                        score, prev = candidate, prev_index
+                new_scores.append(score)
+                back.append(prev)
+            if index >= self.length and scores and max(new_scores, default=-inf) == -inf:
+                # The model has not seen the sentence end, so it tells nothing, as predict does
+                ended = True
+                backs.append(list(range(len(scores))))
+                continue
+            scores = new_scores
+            backs.append(back)
+        if not scores or max(scores) == -inf:
+            return None
+        index = max(range(len(scores)), key=scores.__getitem__)
+        result = []
+        for step in range(len(backs) - 1, 0, -1):
+            index = backs[step][index]
+            if step <= self.length:
+                result.append(self.chars[step - 1][index])
+        return ''.join(reversed(result))
+
+
+def accuracy(results, answers):
+    char_count, char_correct, line_correct = 0, 0, 0
+    for result, answer in zip(results, answers):
+        result = result or ''
+        char_count += len(answer)
+        char_correct += sum(a == b for a, b in zip(result, answer))
+        line_correct += result == answer
+    return char_correct / (char_count or 1), line_correct / (len(answers) or 1)
+
+
+_lattices = []
+_answers = []
+
+
+def _evaluate(weights):
+    return accuracy([lattice and lattice.decode(weights) for lattice in _lattices], _answers)
+
+
+def grid_search(model, file_in, file_answer, grid, output=None, processes=1):
+    """
+    grid is a list of smoothing weights, e.g. (smooth_1, smooth_2, 1 - smooth_1 - smooth_2) for TrigramModel
+    or (smooth, 1 - smooth) for the binary models, writes a tab separated accuracy table into output
+    """
+    global _lattices, _answers
+    inputs = [line.strip() for line in open(file_in) if line.strip()]
+    _answers = [line.strip() for line in open(file_answer) if line.strip()]
+    _lattices = []
+    for line in inputs:
+        try:
+            _lattices.append(Lattice(model, line))
+        except StrangePinyinError as e:
+            print('遇到了无法处理的拼音', e.args[0], file=stderr)
+            _lattices.append(None)
+    print('Finished lattice cache of', len(inputs), 'lines', file=stderr)
+    if processes > 1:
+        # workers are forked after the lattices are cached, so they share them
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            table = pool.map(_evaluate, grid)
+    else:
+        table = [_evaluate(weights) for weights in grid]
+    lines = ['\t'.join(map(str, weights + scores)) for weights, scores in zip(grid, table)]
+    if output:
+        with open(output, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+    print('\n'.join(lines))
+    return table
@@ -0,0 +1,46 @@
+"""
+Bulk merge of pre-aggregated counts into model tables
+"""
+import sqlite3
+
+
+def tune_for_bulk(connection: sqlite3.Connection):
+    """
+    The model database can always be rebuilt, so trade durability for speed while writing it
+    """
+    connection.executescript("""
+        PRAGMA synchronous = OFF;
+        PRAGMA journal_mode = MEMORY;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA cache_size = -262144;
+    """)
+
+
+def merge_counts(connection: sqlite3.Connection, table: str, columns: tuple, rows):
+    """
+    Stream rows of (*columns, count) into a staging table, then add them into table in one sorted upsert,
+    table must have a unique index on columns
+    """
+    staging = 'staging_' + table
+    names = ', '.join(columns)
+    connection.execute(f'DROP TABLE IF EXISTS temp.{staging}')
+    connection.execute(f'CREATE TEMP TABLE {staging} ({names}, count INT)')
+    connection.executemany(f'INSERT INTO {staging} VALUES ({", ".join("?" * (len(columns) + 1))})', rows)
+    # "WHERE true" tells the parser that ON CONFLICT belongs to the upsert rather than to a join
+    connection.execute(f"""
+        INSERT INTO {table} ({names}, count) SELECT {names}, count FROM {staging} WHERE true ORDER BY {names}
+        ON CONFLICT ({names}) DO UPDATE SET count = count + excluded.count
+    """)
+    connection.execute(f'DROP TABLE temp.{staging}')
+
+
+def merge_sorted(connection: sqlite3.Connection, table: str, columns: tuple, rows):
+    """
+    Same as merge_counts for rows which are already unique and sorted by columns, e.g. from a k-way merge,
+    so they are streamed into table without a staging table
+    """
+    names = ', '.join(columns)
+    connection.executemany(f"""
+        INSERT INTO {table} ({names}, count) VALUES ({", ".join("?" * (len(columns) + 1))})
+        ON CONFLICT ({names}) DO UPDATE SET count = count + excluded.count
+    """, rows)
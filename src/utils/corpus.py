@@ -0,0 +1,133 @@
+"""
+Reading the corpus, and a cache of the pinyin annotated corpus so rebuilding a model skips json, gbk and pypinyin
+
+The cache is a flat array of char_set ids, every text (title or html) ends with 0, and chars out of the
+pinyin table are stored as the start id just like the builds count them.
+Layout: header (magic, version, item size, fingerprint) followed by uint16 or uint32 ids, it is mmap-ed
+when reading. The fingerprint covers the corpus files, table.txt and the annotation rules, a stale cache
+is rebuilt while the build counts, and it is only installed once the whole corpus has been annotated.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+
+from tqdm import tqdm
+
+import settings
+
+MAGIC = b'IMCORPUS'
+VERSION = 1
+HEADER = struct.Struct('<8sqq16s')
+
+
+def typecode(size: int):
+    """
+    Typecode of an array holding ids up to size
+    """
+    return 'H' if size < 1 << 16 else 'I'
+
+
+def corpus_files(path: Path):
+    return sorted(file for file in path.iterdir() if settings.key in str(file) and file.is_file())
+
+
+def read_data(path: Path, files=None):
+    """
+    Yield documents of files, by default every corpus file, only the first 2001 lines of each file in debug mode
+    """
+    for file in corpus_files(path) if files is None else files:
+        bar = tqdm(open(file, encoding='gbk'))
+        bar.set_description(str(file))
+        for cnt, line in enumerate(bar):
+            if settings.debug and cnt > 2000:
+                break
+            yield json.loads(line)
+
+
+def fingerprint(path: Path, *rules):
+    digest = hashlib.blake2b(digest_size=16)
+    for file in corpus_files(path):
+        stat = file.stat()
+        digest.update(('%s %d %d\n' % (file.name, stat.st_size, stat.st_mtime_ns)).encode())
+    digest.update(path.joinpath('table.txt').read_bytes())
+    digest.update(repr((settings.key, settings.debug) + rules).encode())
+    return digest.digest()
+
+
+def cache_file(path: Path, name: str):
+    return path.joinpath('cache', name + '.ids')
+
+
+def load(cache_path: Path, digest: bytes):
+    """
+    Return the mmap-ed ids, or None if there is no fresh cache
+    """
+    if not cache_path.exists():
+        return None
+    with open(str(cache_path), 'rb') as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, item_size, cached_digest = HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != VERSION or cached_digest != digest:
+        buffer.close()
+        return None
+    return memoryview(buffer)[HEADER.size:].cast('H' if item_size == 2 else 'I')
+
+
+class Writer:
+    """
+    Write id arrays into a temporary file, which replaces the cache only when closed as complete
+    """
+
+    def __init__(self, cache_path: Path, digest: bytes):
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.cache_path = cache_path
+        self.temp_path = Path(str(cache_path) + '.tmp')
+        self.digest = digest
+        self.file = open(str(self.temp_path), 'wb')
+        self.item_size = None
+
+    def write(self, chunk):
+        if self.item_size is None:
+            self.item_size = chunk.itemsize
+            self.file.write(HEADER.pack(MAGIC, VERSION, self.item_size, self.digest))
+        self.file.write(chunk.tobytes())
+
+    def close(self, complete: bool):
+        self.file.close()
+        if complete and self.item_size is not None:
+            os.replace(str(self.temp_path), str(self.cache_path))
+            print('Finished corpus cache', self.cache_path)
+        else:
+            self.temp_path.unlink(missing_ok=True)
+
+
+def _write(cache_path: Path, digest: bytes, chunks):
+    """
+    Yield every id of chunks while writing them, install the cache only if chunks are exhausted
+    """
+    writer = Writer(cache_path, digest)
+    complete = False
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+            yield from chunk
+        complete = True
+    finally:
+        writer.close(complete)
+
+
+def annotated(name: str, path: Path, annotate, *rules):
+    """
+    Iterate ids of the corpus under path, annotate() yields id arrays and is only called without a fresh cache
+    rules are whatever changes the annotation, e.g. the pinyin fix-up tables of a model
+    """
+    cache_path = cache_file(path, name)
+    digest = fingerprint(path, *rules)
+    ids = load(cache_path, digest)
+    if ids is not None:
+        print('Reading corpus cache', cache_path)
+        return iter(ids)
+    return _write(cache_path, digest, annotate())
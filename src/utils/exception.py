@@ -3,3 +3,9 @@ class StrangePinyinError(Exception):
 
     def __init__(self, pinyin):
         super().__init__(pinyin)
+
+
+class NoPathError(StrangePinyinError):
+    """
+    Every sentence for the pinyin has zero probability under the model
+    """
@@ -0,0 +1,85 @@
+"""
+Ledger of the corpus files counted into a model database, so refreshing a model only counts new files
+
+A file is known by its content hash, size and mtime are kept to skip hashing files which did not change.
+"""
+import hashlib
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+
+
+def create_ledger(connection: sqlite3.Connection):
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS ingested (
+            name TEXT,
+            size INT,
+            mtime INT,
+            hash CHARACTER (32) UNIQUE,
+            time TEXT
+        )
+    """)
+
+
+def file_hash(file: Path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(str(file), 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def pending(model_path: str, files: list, force=False):
+    """
+    Return [(file, size, mtime, hash)] of files not counted into model_path yet,
+    an existing model without ledger has counted unknown files, so it is refused unless force
+    """
+    known_stat, known_hash = {}, {}
+    if Path(model_path).exists():
+        connection = sqlite3.connect(model_path)
+        create_ledger(connection)
+        for name, size, mtime, digest in connection.execute('SELECT name, size, mtime, hash FROM ingested'):
+            known_stat[name, size, mtime] = digest
+            known_hash[digest] = name
+        connection.close()
+        if not known_hash and not force:
+            raise RuntimeError('No ingested files recorded in %s, seed the ledger with --seed if it counts the '
+                               'corpus already, or count every file into it again with --force' % model_path)
+    result = []
+    for file in files:
+        stat = file.stat()
+        if (file.name, stat.st_size, stat.st_mtime_ns) in known_stat:
+            continue
+        digest = file_hash(file)
+        if digest in known_hash:
+            continue
+        known_hash[digest] = file.name
+        result.append((file, stat.st_size, stat.st_mtime_ns, digest))
+    return result
+
+
+def record(connection: sqlite3.Connection, entries: list):
+    """
+    Record entries from pending() in the transaction which inserts their counts, so it is not committed here,
+    raise if another build sharing the database has counted one of them meanwhile
+    """
+    create_ledger(connection)
+    now = datetime.now().isoformat()
+    try:
+        connection.executemany('INSERT INTO ingested VALUES (?, ?, ?, ?, ?)',
+                               ((file.name, size, mtime, digest, now) for file, size, mtime, digest in entries))
+    except sqlite3.IntegrityError:
+        raise RuntimeError('Some of %s are already counted into the model by another build' %
+                           ', '.join(file.name for file, *_ in entries))
+
+
+def seed(model_path: str, files: list):
+    """
+    Record files as ingested without counting them, for a model built before the ledger from these files
+    """
+    entries = pending(model_path, files, force=True)
+    connection = sqlite3.connect(model_path)
+    with connection:
+        record(connection, entries)
+    connection.close()
+    print('Recorded', len(entries), 'of', len(files), 'corpus files as ingested in', model_path)
@@ -1,15 +1,100 @@
+"""
+Shared loader of model databases
+
+The database is opened read-only with mmap and a large page cache, or copied into memory with the
+SQLite backup API, which copies pages instead of rendering and re-executing the whole database as SQL.
+Every table is fetched with one ordered scan, and the time of each loading phase is reported.
+"""
 import sqlite3
-from io import StringIO
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+from time import perf_counter
+from urllib.parse import quote
+
+import settings
+
+PRAGMAS = """
+    PRAGMA mmap_size = 1073741824;
+    PRAGMA cache_size = -65536;
+    PRAGMA temp_store = MEMORY;
+"""
+BLOCK = 1 << 14
+
+
+def connect(db_path: str, in_memory=False, **kwargs):
+    """
+    Open db_path read-only, or a copy of it in memory
+    """
+    uri = 'file:%s?mode=ro' % quote(str(Path(db_path).resolve()))
+    connection = sqlite3.connect(uri, uri=True, **kwargs)
+    connection.executescript(PRAGMAS)
+    if in_memory:
+        memory = sqlite3.connect(':memory:', **kwargs)
+        connection.backup(memory)
+        connection.close()
+        connection = memory
+    return connection
+
+
+def relation_dict(rows, result=None):
+    """
+    Group rows of (left, right, count) sorted by left into {left: {right: count}}
+    """
+    result = {} if result is None else result
+    for left, group in groupby(rows, key=itemgetter(0)):
+        result[left] = {right: count for _, right, count in group}
+    return result
 
 
 def load_db_into_memory(db_path='db.sqlite3'):
-    connection = sqlite3.connect(db_path)
-    file = StringIO('\n'.join(connection.iterdump()))
-    connection.close()
-    file.seek(0)
-    connection = sqlite3.connect(':memory:')
-    connection.executescript(file.read())
-    connection.commit()
+    connection = connect(db_path, in_memory=True)
     connection.row_factory = sqlite3.Row
     print('Finished load db into memory ')
     return connection
+
+
+class Loader:
+    """
+    Connection of one model load, timing every phase
+    """
+
+    def __init__(self, db_path: str, in_memory=None):
+        self.timing = {}
+        in_memory = settings.load_in_memory if in_memory is None else in_memory
+        with self.phase('memory copy' if in_memory else 'connect'):
+            self.connection = connect(db_path, in_memory)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = perf_counter()
+        yield
+        self.timing[name] = self.timing.get(name, 0) + perf_counter() - start
+
+    def _rows(self, name: str, sql: str, parameters):
+        cursor = self.connection.execute(sql, parameters)
+        while True:
+            start = perf_counter()
+            rows = cursor.fetchmany(BLOCK)
+            self.timing[name + ' fetch'] += perf_counter() - start
+            if not rows:
+                return
+            yield from rows
+
+    def table(self, name: str, sql: str, build=list, *parameters):
+        """
+        Return build(rows) of one ordered scan, rows are streamed so the whole result never sits in memory,
+        the time spent in sqlite and in build is recorded apart
+        """
+        self.timing[name + ' fetch'] = 0
+        start = perf_counter()
+        result = build(self._rows(name, sql, parameters))
+        self.timing[name + ' build'] = perf_counter() - start - self.timing[name + ' fetch']
+        return result
+
+    def report(self):
+        return ', '.join('%s %.3fs' % each for each in self.timing.items())
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,174 @@
+"""
+N-gram count tables stored as sorted integer arrays
+
+A key such as (left, right) is packed into one 64-bit integer, so a lookup is a binary search over a flat
+array instead of hashing a tuple. The arrays only need to support len() and indexing, so they can be an
+array.array in memory or a memoryview over a mmap-ed compiled model file.
+In memory, char ids and counts are 32-bit, so one n-gram costs 12 or 16 bytes instead of a tuple key,
+two int objects and a dict slot. A compiled file may also store counts as codes of a few bits, see Quantized.
+"""
+from array import array
+from bisect import bisect_left
+
+SHIFT = 32
+# typecodes of keys, rights and counts built in memory, compiled files use 'q' for all of them
+KEY = 'q'
+RIGHT = 'i'
+COUNT = 'I'
+
+
+def pack(left: int, right: int):
+    return left << SHIFT | right
+
+
+def unpack(key: int):
+    return key >> SHIFT, key & ((1 << SHIFT) - 1)
+
+
+class PackedBigram:
+    """
+    Read-only mapping (left, right) -> count, with the same get() as the dict it replaces
+    """
+
+    def __init__(self, keys, counts):
+        self.keys = keys
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, key, default=None):
+        keys = self.keys
+        key = key[0] << SHIFT | key[1]
+        index = bisect_left(keys, key)
+        if index != len(keys) and keys[index] == key:
+            return self.counts[index]
+        return default
+
+    @classmethod
+    def from_rows(cls, rows, typecodes=(KEY, COUNT)):
+        """
+        rows are (left, right, count) sorted by (left, right)
+        """
+        keys, counts = array(typecodes[0]), array(typecodes[1])
+        for left, right, count in rows:
+            keys.append(left << SHIFT | right)
+            counts.append(count)
+        return cls(keys, counts)
+
+
+class Quantized:
+    """
+    Read-only count array of codes packed bits wide into bytes, where the count of a code is levels[code]
+    """
+
+    def __init__(self, codes, levels, bits: int, length: int):
+        self.codes = codes
+        self.levels = levels
+        self.bits = bits
+        self.per = 8 // bits
+        self.mask = (1 << bits) - 1
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[each] for each in range(*index.indices(self.length))]
+        return self.levels[self.codes[index // self.per] >> index % self.per * self.bits & self.mask]
+
+
+class Bucket:
+    """
+    Read-only mapping right -> count for one left or (left, middle), a slice of PackedRelation
+    """
+    __slots__ = ('rights', 'counts', 'lo', 'hi')
+
+    def __init__(self, rights, counts, lo, hi):
+        self.rights = rights
+        self.counts = counts
+        self.lo = lo
+        self.hi = hi
+
+    def __len__(self):
+        return self.hi - self.lo
+
+    def get(self, right, default=None):
+        index = bisect_left(self.rights, right, self.lo, self.hi)
+        if index != self.hi and self.rights[index] == right:
+            return self.counts[index]
+        return default
+
+    def items(self):
+        return zip(self.rights[self.lo:self.hi], self.counts[self.lo:self.hi])
+
+
+class PackedRelation:
+    """
+    Read-only mapping left -> Bucket in CSR layout:
+    keys[i] is the left, and its rights/counts live in [offsets[i], offsets[i + 1])
+    """
+
+    def __init__(self, keys, offsets, rights, counts):
+        self.keys = keys
+        self.offsets = offsets
+        self.rights = rights
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, key, default=None):
+        keys = self.keys
+        index = bisect_left(keys, key)
+        if index != len(keys) and keys[index] == key:
+            return Bucket(self.rights, self.counts, self.offsets[index], self.offsets[index + 1])
+        return default
+
+    def __getitem__(self, key):
+        # like the defaultdict(dict) it replaces, a missing left is an empty bucket
+        return PackedRelation.get(self, key, Bucket(self.rights, self.counts, 0, 0))
+
+    @staticmethod
+    def _key(row):
+        return row[0]
+
+    @classmethod
+    def from_rows(cls, rows, typecodes=(KEY, KEY, RIGHT, COUNT)):
+        """
+        rows are (left, right, count) for PackedRelation or (left, middle, right, count) for PackedTrigram,
+        sorted by every column but count
+        """
+        keys, offsets, rights, counts = (array(typecode) for typecode in typecodes)
+        for row in rows:
+            key = cls._key(row)
+            if not keys or keys[-1] != key:
+                keys.append(key)
+                offsets.append(len(rights))
+            rights.append(row[-2])
+            counts.append(row[-1])
+        offsets.append(len(rights))
+        return cls(keys, offsets, rights, counts)
+
+
+class PackedTrigram(PackedRelation):
+    """
+    Read-only mapping (left, middle) -> Bucket, keys[i] is the packed (left, middle)
+    """
+
+    def get(self, key, default=None):
+        # inlined rather than calling PackedRelation.get, this is the hottest lookup of TrigramModel
+        keys = self.keys
+        key = key[0] << SHIFT | key[1]
+        index = bisect_left(keys, key)
+        if index != len(keys) and keys[index] == key:
+            return Bucket(self.rights, self.counts, self.offsets[index], self.offsets[index + 1])
+        return default
+
+    def __getitem__(self, key):
+        return PackedRelation.__getitem__(self, key[0] << SHIFT | key[1])
+
+    @staticmethod
+    def _key(row):
+        return row[0] << SHIFT | row[1]
@@ -0,0 +1,91 @@
+"""
+Segmentation of pinyin typed without spaces, such as "woaibeijing"
+
+The syllables of a model are compiled into a trie flattened into one dict {prefix: is a syllable},
+so walking it from a position is one dict lookup per char and stops as soon as no syllable starts so.
+Spaces and apostrophes ("xi'an") are kept as forced boundaries, and a token which is a syllable itself
+is never split, so spaced input is read exactly as before.
+With partial, a token which can not be segmented into whole syllables may also use the prefixes of
+syllables, such as "zg" for "zhong guo", the model then gives candidates for those prefixes, and only
+the segmentations of the fewest pieces are kept as the candidates of a prefix are many.
+"""
+from math import inf
+
+from utils.exception import StrangePinyinError
+
+
+class SyllableTrie:
+    def __init__(self, syllables, partial=False):
+        self.partial = partial
+        self.nodes = {}
+        for syllable in syllables:
+            for end in range(1, len(syllable)):
+                self.nodes.setdefault(syllable[:end], False)
+            self.nodes[syllable] = True
+
+    def _edges(self, token: str, partial: bool):
+        """
+        Return edges, edges[i] is [(j, syllable)] of the syllables on some full segmentation of token[i:]
+        """
+        length = len(token)
+        edges = [[] for _ in range(length)]
+        for start in range(length):
+            for end in range(start + 1, length + 1):
+                is_syllable = self.nodes.get(token[start:end])
+                if is_syllable is None:
+                    break
+                if is_syllable or partial:
+                    edges[start].append((end, token[start:end]))
+        # Keep only the syllables followed by a full segmentation of the rest, going backwards,
+        # with prefixes only those on the segmentations of the fewest pieces, such as "zhong g" for "zhongg"
+        pieces = [inf] * length + [0]
+        for start in range(length - 1, -1, -1):
+            edges[start] = [(end, syllable) for end, syllable in edges[start] if pieces[end] < inf]
+            pieces[start] = min((pieces[end] + 1 for end, _ in edges[start]), default=inf)
+            if partial:
+                edges[start] = [(end, syllable) for end, syllable in edges[start]
+                                if pieces[end] + 1 == pieces[start]]
+        return edges
+
+    def _token(self, token: str, offset: int, lattice: list):
+        """
+        Fill lattice[offset + i] with the syllables of token[i:] on some full segmentation of token
+        """
+        if self.nodes.get(token):
+            lattice[offset].append((offset + len(token), token))
+            return
+        edges = self._edges(token, False)
+        if not edges[0] and self.partial:
+            edges = self._edges(token, True)
+        if not edges[0]:
+            raise StrangePinyinError(token)
+        for start, each in enumerate(edges):
+            lattice[offset + start].extend((offset + end, syllable) for end, syllable in each)
+
+    def lattice(self, pinyin: str):
+        """
+        Return lattice, lattice[i] is [(j, syllable)] of the syllables spanning text[i:j] on some full
+        segmentation, where text is pinyin without separators
+        """
+        tokens = pinyin.lower().replace("'", ' ').split()
+        lattice = [[] for _ in range(sum(map(len, tokens)))]
+        offset = 0
+        for token in tokens:
+            self._token(token, offset, lattice)
+            offset += len(token)
+        return lattice
+
+    def segment(self, pinyin: str):
+        """
+        Return (syllables, None) if there is only one segmentation, or else (None, lattice)
+        """
+        lattice = self.lattice(pinyin)
+        syllables = []
+        position = 0
+        while position < len(lattice):
+            edges = lattice[position]
+            if len(edges) != 1:
+                return None, lattice
+            position, syllable = edges[0]
+            syllables.append(syllable)
+        return syllables, None
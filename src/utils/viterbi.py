@@ -0,0 +1,136 @@
+"""
+Vectorized viterbi decoding for NaiveBinaryModel and PinyinBinaryModel
+
+For two adjacent syllables the transition block is a dense (right, left) array, so each step is a few
+numpy operations instead of a python double loop. It does the same float operations in the same order
+as the python implementation, and ties break towards the first left as max() does, so outputs match.
+"""
+import threading
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is optional, models fall back to the python implementation
+    np = None
+
+
+class BinaryViterbi:
+    """
+    p(right | left) = smooth * count(left, right) / count(left) + (1 - smooth) * p(right)
+    """
+
+    def __init__(self, char_to_count, char_to_likelihood, relation, smooth, skip_unseen=False, capacity=100000):
+        self.count = np.array(char_to_count, dtype=np.float64)
+        self.likelihood = np.array(char_to_likelihood, dtype=np.float64)
+        self.relation = relation
+        self.smooth = smooth
+        # NaiveBinaryModel ignores lefts never seen in corpus
+        self.skip_unseen = skip_unseen
+        # syllable -> (candidate array, {candidate: position})
+        self.candidates = {}
+        # LRU of (left, syllable) -> (positions of related candidates, counts), at most capacity of them
+        self.rows = OrderedDict()
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.empty_row = np.zeros(0, dtype=np.intp), np.zeros(0)
+
+    @staticmethod
+    def available():
+        return np is not None
+
+    def _candidates(self, key, candidates):
+        entry = self.candidates.get(key)
+        if entry is None:
+            ids = list(dict.fromkeys(candidates))
+            entry = self.candidates[key] = np.array(ids, dtype=np.int64), {c: i for i, c in enumerate(ids)}
+        return entry
+
+    def _row(self, left, key, position):
+        """
+        Called with the lock held
+        """
+        rows = self.rows
+        row = rows.get((left, key))
+        if row is not None:
+            self.hits += 1
+            rows.move_to_end((left, key))
+            return row
+        self.misses += 1
+        pairs = [(position[right], count) for right, count in self.relation.get(left, {}).items()
+                 if right in position]
+        row = pairs and (np.array([each[0] for each in pairs], dtype=np.intp),
+                         np.array([each[1] for each in pairs], dtype=np.float64)) or self.empty_row
+        rows[left, key] = row
+        if len(rows) > self.capacity:
+            rows.popitem(last=False)
+        return row
+
+    def start_state(self, start):
+        """
+        A state is (candidate ids, best scores, back pointers into the last state)
+        """
+        return np.array([start], dtype=np.int64), np.ones(1), None
+
+    def _transition(self, lefts, key, candidates):
+        """
+        Return (rights, kept positions of lefts, p(right | left) block of shape (rights, kept lefts))
+        """
+        smooth = self.smooth
+        rights, position = self._candidates(key, candidates)
+        if self.skip_unseen:
+            keep = np.flatnonzero(self.count[lefts])
+        else:
+            keep = np.arange(len(lefts))
+        block = np.zeros((len(rights), len(keep)))
+        with self.lock:
+            for column, left in enumerate(lefts[keep].tolist()):
+                positions, counts = self._row(left, key, position)
+                block[positions, column] = counts
+        count = self.count[lefts[keep]]
+        p2 = block / np.where(count, count, 1)
+        p1 = self.likelihood[rights][:, None]
+        return rights, keep, smooth * p2 + (1 - smooth) * p1
+
+    def next_state(self, last_state, key, candidates):
+        lefts, scores, _ = last_state
+        rights, keep, p = self._transition(lefts, key, candidates)
+        transition = scores[keep][None, :] * p
+        back = transition.argmax(axis=1)
+        return rights, transition[np.arange(len(rights)), back], keep[back]
+
+    def lattice_step(self, last_scores, key, candidates):
+        """
+        One step of lattice decoding in log space, {left: score} -> {right: (score, left)}
+        """
+        lefts = np.fromiter(last_scores, dtype=np.int64, count=len(last_scores))
+        scores = np.fromiter(last_scores.values(), dtype=np.float64, count=len(last_scores))
+        rights, keep, p = self._transition(lefts, key, candidates)
+        if not len(keep):
+            return {}
+        with np.errstate(divide='ignore'):
+            transition = scores[keep][None, :] + np.log(p)
+        back = transition.argmax(axis=1)
+        best = transition[np.arange(len(rights)), back]
+        return {right: (score, left) for right, score, left in
+                zip(rights.tolist(), best.tolist(), lefts[keep[back]].tolist()) if score > -np.inf}
+
+    def finish(self, states, stop):
+        """
+        Return the best char ids after the start state
+        """
+        end = self.next_state(states[-1], None, (stop,))
+        if end[1][0] or len(states) == 1:
+            states = states + [end]
+            result = []
+            index = 0
+        else:
+            # The model has not seen the sentence end, so it tells nothing, start from the best last state
+            index = int(states[-1][1].argmax())
+            result = [int(states[-1][0][index])]
+        for current in range(len(states) - 1, 1, -1):
+            index = states[current][2][index]
+            result.append(int(states[current - 1][0][index]))
+        return result[::-1]